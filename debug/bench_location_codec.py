@@ -0,0 +1,35 @@
+"""Compare encode / decode throughput of the location update encodings"""
+import argparse
+import timeit
+
+from src.util.location_codec import decode_location
+from src.util.location_codec import encode_location
+from src.util.location_codec import location_topic
+from src.util.location_codec import TOPICS_BY_ENCODING
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=100000)
+    return parser
+
+
+def main() -> None:
+    args = get_parser().parse_args()
+    bot_id = "3f2c1b8e-9a47-4d2e-8c1f-5b6a7d8e9f01"
+    lat, lon = 37.80343755635129, -122.40794651273026
+
+    for encoding in TOPICS_BY_ENCODING:
+        topic = location_topic(encoding)
+        payload = encode_location(bot_id, lat, lon, encoding=encoding)
+        encode_s = timeit.timeit(lambda: encode_location(bot_id, lat, lon, encoding=encoding), number=args.count)
+        decode_s = timeit.timeit(lambda: decode_location(topic, payload), number=args.count)
+        print(
+            f"{encoding:>6}: {len(payload):4d} bytes, "
+            f"encode {args.count / encode_s:10.0f} msg/s, "
+            f"decode {args.count / decode_s:10.0f} msg/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
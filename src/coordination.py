@@ -0,0 +1,431 @@
+"""
+Spread bots across several location service instances.
+
+Every bot started through /start gets written to a shared registry. Instances heartbeat into
+the same store, and each bot is owned by whichever live instance its region and handle hash to
+on a consistent hash ring. When an instance stops heartbeating, the survivors pick up its bots
+and resume them from the last position they published to the location cache.
+
+Ownership only changes through an atomic claim that fails if the current owner is still
+heartbeating, so two instances can't both take a bot even if their views of who is alive
+disagree. An instance that finds one of its bots owned by someone else stops it.
+
+The store is Redis in production. LocalStore implements the same handful of commands in
+process, for running a single instance or poking at this without a Redis server.
+"""
+import bisect
+import hashlib
+import json
+import threading
+import time
+import typing as T
+from uuid import uuid4
+
+from src.util.location_cache import get_position
+
+
+REGISTRY_KEY = "location-service:bots"
+INSTANCES_KEY = "location-service:instances"
+
+# {handle: record} -> {handle: (thread, bot_id)} for the bots that started
+LaunchFn = T.Callable[[T.Dict[str, T.Dict]], T.Dict[str, T.Tuple[threading.Thread, str]]]
+# (handle, check_in) -> None, stops a local bot, leaving it checked out unless check_in is set
+StopFn = T.Callable[[str, bool], None]
+
+# Take a bot if it's unowned, already ours, or its owner has stopped heartbeating.
+# KEYS: registry, instances  ARGV: handle, instance ID, stale heartbeat cutoff, new record
+CLAIM_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if not current then
+    return 0
+end
+local owner = cjson.decode(current)['owner']
+if owner and owner ~= cjson.null and owner ~= ARGV[2] then
+    local heartbeat = redis.call('ZSCORE', KEYS[2], owner)
+    if heartbeat and tonumber(heartbeat) >= tonumber(ARGV[3]) then
+        return 0
+    end
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[4])
+return 1
+"""
+
+# Overwrite a bot's record, or drop it if the new record is empty, only if we still own it.
+# KEYS: registry  ARGV: handle, instance ID, new record
+OWNED_WRITE_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if not current or cjson.decode(current)['owner'] ~= ARGV[2] then
+    return 0
+end
+if ARGV[3] == '' then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+else
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+end
+return 1
+"""
+
+
+def _decode(value: T.Union[str, bytes]) -> str:
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring, so an instance joining or leaving only moves the bots it owns.
+    """
+
+    def __init__(self, members: T.Iterable[str], replicas: int = 64):
+        self._ring = sorted((_hash(f"{member}#{idx}"), member) for member in members for idx in range(replicas))
+        self._points = [point for point, _ in self._ring]
+
+    def get(self, key: str) -> T.Optional[str]:
+        if not self._ring:
+            return None
+        idx = bisect.bisect(self._points, _hash(key)) % len(self._ring)
+        return self._ring[idx][1]
+
+
+class LocalStore:
+    """
+    In-process stand-in for the Redis commands the coordinator uses.
+    """
+
+    def __init__(self):
+        self._hashes: T.Dict[str, T.Dict[str, str]] = dict()
+        self._zsets: T.Dict[str, T.Dict[str, float]] = dict()
+        self._lock = threading.Lock()
+
+    def hset(self, name: str, key: str, value: str) -> None:
+        with self._lock:
+            self._hashes.setdefault(name, dict())[key] = value
+
+    def hget(self, name: str, key: str) -> T.Optional[str]:
+        with self._lock:
+            return self._hashes.get(name, dict()).get(key)
+
+    def hdel(self, name: str, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                self._hashes.get(name, dict()).pop(key, None)
+
+    def hgetall(self, name: str) -> T.Dict[str, str]:
+        with self._lock:
+            return dict(self._hashes.get(name, dict()))
+
+    def zadd(self, name: str, mapping: T.Dict[str, float]) -> None:
+        with self._lock:
+            self._zsets.setdefault(name, dict()).update(mapping)
+
+    def zrangebyscore(self, name: str, min: float, max: float) -> T.List[str]:
+        with self._lock:
+            zset = self._zsets.get(name, dict())
+            return [k for k, v in sorted(zset.items(), key=lambda x: x[1]) if min <= v <= max]
+
+    def zremrangebyscore(self, name: str, min: float, max: float) -> None:
+        with self._lock:
+            zset = self._zsets.get(name, dict())
+            for key in [k for k, v in zset.items() if min <= v <= max]:
+                del zset[key]
+
+    def zscore(self, name: str, key: str) -> T.Optional[float]:
+        with self._lock:
+            return self._zsets.get(name, dict()).get(key)
+
+    def zrem(self, name: str, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                self._zsets.get(name, dict()).pop(key, None)
+
+    def register_script(self, script: str) -> T.Callable[..., int]:
+        """
+        Python versions of the coordinator's Lua scripts, run under the store lock so they're
+        atomic like the scripts are in Redis.
+        """
+        scripts = {
+            CLAIM_SCRIPT: self._claim,
+            OWNED_WRITE_SCRIPT: self._owned_write,
+        }
+        fn = scripts[script]
+
+        def run(keys: T.List[str], args: T.List) -> int:
+            with self._lock:
+                return fn(*keys, *args)
+        return run
+
+    def _claim(self, registry: str, instances: str, handle: str, instance_id: str, stale_before: float, value: str) -> int:
+        current = self._hashes.get(registry, dict()).get(handle)
+        if current is None:
+            return 0
+        owner = json.loads(current)["owner"]
+        if owner is not None and owner != instance_id:
+            heartbeat = self._zsets.get(instances, dict()).get(owner)
+            if heartbeat is not None and heartbeat >= float(stale_before):
+                return 0
+        self._hashes[registry][handle] = value
+        return 1
+
+    def _owned_write(self, registry: str, handle: str, instance_id: str, value: str) -> int:
+        current = self._hashes.get(registry, dict()).get(handle)
+        if current is None or json.loads(current)["owner"] != instance_id:
+            return 0
+        if value == '':
+            del self._hashes[registry][handle]
+        else:
+            self._hashes[registry][handle] = value
+        return 1
+
+
+class Coordinator:
+    """
+    Tracks which instance owns which bot and starts the bots this instance is responsible for.
+
+    `launch` is supplied by the server. It gets the records (start request plus bookkeeping)
+    of every bot a sync claimed and starts them, returning the thread each one runs on and its
+    bot ID. Bots it couldn't start are left out and retried on the next sync. `stop`
+    stops a local bot, either checking it in because it was removed from the registry, or
+    leaving it checked out for an instance that took it over.
+    """
+
+    def __init__(
+        self,
+        store,
+        launch: LaunchFn,
+        stop: StopFn,
+        instance_id: str = None,
+        heartbeat_timeout: float = 15.0,
+    ):
+        self._store = store
+        self._launch = launch
+        self._stop_bot = stop
+        self.instance_id = instance_id or f"instance-{uuid4()}"
+        self._heartbeat_timeout = heartbeat_timeout
+        self._claim_script = store.register_script(CLAIM_SCRIPT)
+        self._owned_write_script = store.register_script(OWNED_WRITE_SCRIPT)
+        self._running: T.Dict[str, threading.Thread] = dict()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+
+    def heartbeat(self) -> None:
+        now = time.time()
+        self._store.zadd(INSTANCES_KEY, {self.instance_id: now})
+        self._store.zremrangebyscore(INSTANCES_KEY, 0, now - self._heartbeat_timeout)
+
+    def heartbeat_forever(self) -> None:
+        # a few beats per timeout, so one slow write doesn't get us declared dead
+        while not self._stopped.wait(self._heartbeat_timeout / 3):
+            try:
+                self.heartbeat()
+            except Exception as exc:
+                print(f'Coordinator heartbeat failed: {exc!r}')
+
+    def live_instances(self) -> T.List[str]:
+        now = time.time()
+        return [_decode(x) for x in self._store.zrangebyscore(INSTANCES_KEY, now - self._heartbeat_timeout, float('inf'))]
+
+    def get_bots(self) -> T.Dict[str, T.Dict]:
+        return {_decode(k): json.loads(v) for k, v in self._store.hgetall(REGISTRY_KEY).items()}
+
+    def _save(self, handle: str, record: T.Dict) -> None:
+        self._store.hset(REGISTRY_KEY, handle, json.dumps(record))
+
+    def _claim(self, handle: str, record: T.Dict) -> bool:
+        """
+        Atomically make this instance the bot's owner, unless another live instance owns it.
+        """
+        stale_before = time.time() - self._heartbeat_timeout
+        claimed = dict(record, owner=self.instance_id)
+        args = [handle, self.instance_id, stale_before, json.dumps(claimed)]
+        return bool(self._claim_script(keys=[REGISTRY_KEY, INSTANCES_KEY], args=args))
+
+    def _write_owned(self, handle: str, record: T.Optional[T.Dict]) -> bool:
+        """
+        Update a bot's record, or drop it if the record is None, only while this instance owns it.
+        """
+        value = '' if record is None else json.dumps(record)
+        return bool(self._owned_write_script(keys=[REGISTRY_KEY], args=[handle, self.instance_id, value]))
+
+    def register_bot(self, handle: str, spec: T.Dict) -> T.Optional[str]:
+        """
+        Add a bot to the registry and assign it to an instance. Returns the owning instance.
+        """
+        return self.register_bots({handle: spec})[0]
+
+    def register_bots(self, specs: T.Dict[str, T.Dict]) -> T.List[T.Optional[str]]:
+        """
+        Add several bots to the registry and wake the sync thread to start them. Returns the
+        instance each bot is expected to run on.
+
+        Nothing is checked out or started here, so callers don't wait on the backend.
+        """
+        for handle, spec in specs.items():
+            self._save(handle, dict(spec, handle=handle, owner=None, bot_id=None, started_at=time.time()))
+        self._wake.set()
+        ring = HashRing(self.live_instances())
+        return [ring.get(f"{spec['region']}:{handle}") for handle, spec in specs.items()]
+
+    def bot_finished(self, handle: str) -> None:
+        """
+        Drop a bot that ran to completion so nobody tries to resume it.
+
+        Bots this instance lost to another one, or is leaving behind as it shuts down, stay in
+        the registry for their new owner.
+        """
+        with self._lock:
+            self._running.pop(handle, None)
+        if self._stopped.is_set():
+            # shutting down, whoever takes over resumes it
+            return
+        self._write_owned(handle, None)
+
+    def remove_bots(self, region: str = None) -> T.List[str]:
+        """
+        Remove every bot, or every bot in a region, from the registry. Returns their handles.
+
+        Bots that haven't been claimed yet never start, and each instance stops and checks in
+        its own copies of the rest on its next sync.
+        """
+        handles = [
+            handle for handle, record in self.get_bots().items()
+            if region is None or record.get("region") == region
+        ]
+        if handles:
+            self._store.hdel(REGISTRY_KEY, *handles)
+        # stop ours right away rather than on the next period
+        self._wake.set()
+        return handles
+
+    def _stop_lost(self, bots: T.Dict[str, T.Dict]) -> None:
+        """
+        Stop local bots whose registry entry is gone or now belongs to another instance.
+        """
+        with self._lock:
+            running = dict(self._running)
+        for handle, thread in running.items():
+            record = bots.get(handle)
+            if record is not None and record["owner"] == self.instance_id:
+                continue
+            with self._lock:
+                self._running.pop(handle, None)
+            if not thread.is_alive():
+                continue
+            if record is None:
+                print(f'Bot {handle} was removed, stopping it')
+                self._stop_bot(handle, True)
+            else:
+                print(f'Lost bot {handle} to {record["owner"]}, stopping it')
+                self._stop_bot(handle, False)
+
+    def sync(self) -> None:
+        """
+        Stop bots this instance no longer owns, then claim and start any bot that hashes to this
+        instance and has no live owner.
+        """
+        with self._sync_lock:
+            live = set(self.live_instances())
+            ring = HashRing(live)
+            bots = self.get_bots()
+            self._stop_lost(bots)
+            claimed = dict()
+            for handle, record in bots.items():
+                if record["owner"] == self.instance_id:
+                    with self._lock:
+                        if handle in self._running:
+                            # still running, or finished without checking out of the registry
+                            continue
+                elif record["owner"] in live:
+                    continue
+                if ring.get(f"{record['region']}:{handle}") != self.instance_id:
+                    continue
+                record = self._claim_for_resume(handle, record)
+                if record is not None:
+                    claimed[handle] = record
+            if claimed:
+                self._start(claimed)
+
+    def _claim_for_resume(self, handle: str, record: T.Dict) -> T.Optional[T.Dict]:
+        """
+        Claim a bot, picking it up where its last owner left off if it had one. Returns the
+        claimed record, or None if another instance got it.
+
+        The resume position and remaining duration are worked out before the claim and written
+        with it, so a bot taken over is never restarted from scratch.
+        """
+        previous_owner = record["owner"]
+        taking_over = previous_owner not in (None, self.instance_id)
+        if taking_over:
+            record = self._resume_state(handle, record)
+        if not self._claim(handle, record):
+            print(f'Bot {handle} was claimed by another instance first')
+            return None
+        if taking_over:
+            print(f'Took over bot {handle} from {previous_owner}')
+        return dict(record, owner=self.instance_id)
+
+    def _resume_state(self, handle: str, record: T.Dict) -> T.Dict:
+        """
+        Get a copy of a record moved to the bot's last published position, with whatever is
+        left of its duration. Keeps the stored position if the location cache can't be read.
+        """
+        record = dict(record)
+        if record["bot_id"] is not None:
+            try:
+                position = get_position(f"BOT-{record['bot_id']}")
+            except Exception as exc:
+                print(f'Failed to look up where bot {handle} was: {exc!r}')
+                position = None
+            if position is not None:
+                record["latitude"], record["longitude"] = position
+        if record.get("duration") is not None:
+            record["duration"] = max(record["duration"] - (time.time() - record["started_at"]), 0.0)
+            record["started_at"] = time.time()
+        return record
+
+    def _start(self, records: T.Dict[str, T.Dict]) -> None:
+        launched = self._launch(records)
+        for handle, (thread, bot_id) in launched.items():
+            with self._lock:
+                self._running[handle] = thread
+            record = records[handle]
+            if record["bot_id"] != bot_id:
+                record["bot_id"] = bot_id
+                self._write_owned(handle, record)
+
+    def run_forever(self, period: float = 5.0) -> None:
+        while not self._stopped.is_set():
+            self._wake.clear()
+            try:
+                self.sync()
+            except Exception as exc:
+                print(f'Coordinator sync failed: {exc!r}')
+            # registering bots wakes us early
+            self._wake.wait(period)
+
+    def start(self, period: float = 5.0) -> None:
+        """
+        Heartbeat and sync on background threads. Heartbeats get their own thread so a slow sync
+        can't make this instance look dead.
+        """
+        self.heartbeat()
+        for target, args in ((self.heartbeat_forever, ()), (self.run_forever, (period,))):
+            thread = threading.Thread(target=target, args=args)
+            thread.daemon = True
+            thread.start()
+
+    def shutdown(self) -> None:
+        """
+        Stop heartbeating and syncing, and drop out of the live instances so the survivors take
+        over this instance's bots on their next sync. The registry is left as it is.
+        """
+        self._stopped.set()
+        self._wake.set()
+        try:
+            self._store.zrem(INSTANCES_KEY, self.instance_id)
+        except Exception as exc:
+            print(f'Failed to leave the live instances: {exc!r}')
@@ -2,19 +2,29 @@
 Subscribe to location messages and update cache
 """
 import argparse
-import json
 import os
 import random
+import time
 import typing as T
 
 import redis
 from paho.mqtt import client as mqtt_client
 
+from src.util.location_codec import decode_location
+from src.util.location_codec import encoding_for_topic
+from src.util.location_codec import subscription_filters
+from src.util.location_codec import TOPICS_BY_ENCODING
+from src.util.location_cache import expire_positions
+from src.util.location_cache import store_entity
+
 if T.TYPE_CHECKING:
     from paho.mqtt.client import MQTTMessage
 
 REDIS_AUTH = os.environ.get("REDIS_AUTH")
 
+# how often to drop positions that have aged out of the proximity index
+GEO_EXPIRE_PERIOD = 10.0
+
 
 def get_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description=__doc__)
@@ -46,24 +56,22 @@ def main() -> None:
             print("Failed to connect, return code %d\n", rc)
     m_client.on_connect = on_connect
     m_client.connect(args.broker_address, args.broker_port)
-    m_client.subscribe("gamestate-Location-Update")
+    for encoding in TOPICS_BY_ENCODING:
+        for topic_filter in subscription_filters(encoding):
+            m_client.subscribe(topic_filter)
     print('setup mqtt')
 
+    last_expire = time.time()
+
     def publish_to_redis(client, userdata, message: "MQTTMessage"):
-        if not message.topic == "gamestate-Location-Update":
+        nonlocal last_expire
+        if encoding_for_topic(message.topic) is None:
             return
-        payload = json.loads(message.payload)
-        entity = payload.get('entity')
-        if entity is None:
-            raise ValueError("Malformed packet - no entity")
-        uuid = entity.get("uuid")
-        if uuid is None:
-            raise ValueError("Malformed packet - no uuid")
-        device_id = entity.get("device_id")
-        if device_id is None:
-            raise ValueError("Malformed entity - no device ID")
-        r_client.set(device_id, json.dumps(entity))
-        r_client.expire(device_id, 300)  # have a TTL of 5 minutes
+        entity = decode_location(message.topic, message.payload)
+        store_entity(entity, client=r_client)  # have a TTL of 5 minutes
+        if time.time() - last_expire > GEO_EXPIRE_PERIOD:
+            last_expire = time.time()
+            expire_positions(client=r_client)
 
     m_client.on_message = publish_to_redis
     print('yaeeet')
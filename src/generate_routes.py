@@ -2,70 +2,220 @@
 Given some set of map files for a region, generate a graph network of all roads.
 """
 import argparse
+import heapq
 import math
+from array import array
 import networkx as nx
 import os
+import pickle
 import random
+import threading
+import time
 import typing as T
+from collections import defaultdict
 from networkx.algorithms.shortest_paths.generic import shortest_path
+from networkx.algorithms.shortest_paths.weighted import dijkstra_predecessor_and_distance
 from xml.etree import ElementTree as ET
 
 from src.util.distance import dist_range
+from src.util.distance import haversine_meters
+from src.util.distance import METERS_PER_DEGREE
 from src.util.osm_dir import OSM_DIR
 
 
+# size in degrees of the grid cells nodes are bucketed by for closest node lookups
+CELL_SIZE = 0.002
+# how far around a point closest node lookups look before scanning every node, in meters
+CLOSEST_NODE_SEARCH_RADII = (250.0, 1000.0, 4000.0)
+
+
+class NodeStore:
+    """
+    Struct of arrays holding the id and position of every node in a map.
+
+    Graphs are keyed by each node's index in here rather than by Node objects, so the only
+    per-node cost is an id string and two doubles.
+    """
+
+    def __init__(self, ref_ids: T.List[str] = None, lats: array = None, lons: array = None):
+        self.ref_ids: T.List[str] = ref_ids if ref_ids is not None else []
+        self.lats = lats if lats is not None else array('d')
+        self.lons = lons if lons is not None else array('d')
+        self._indices: T.Dict[str, int] = {ref_id: idx for idx, ref_id in enumerate(self.ref_ids)}
+
+    def __len__(self) -> int:
+        return len(self.ref_ids)
+
+    def __contains__(self, ref_id: str) -> bool:
+        return ref_id in self._indices
+
+    def add(self, ref_id: str, latitude: float, longitude: float) -> int:
+        """
+        Add a node if it isn't already stored. Returns its index either way.
+        """
+        idx = self._indices.get(ref_id)
+        if idx is None:
+            idx = len(self.ref_ids)
+            self._indices[ref_id] = idx
+            self.ref_ids.append(ref_id)
+            self.lats.append(float(latitude))
+            self.lons.append(float(longitude))
+        return idx
+
+    def index_of(self, ref_id: str) -> int:
+        return self._indices[ref_id]
+
+    def state(self) -> T.Tuple[T.List[str], array, array]:
+        return self.ref_ids, self.lats, self.lons
+
+
 class Node:
     """
     Represents a point on the map that a route can go through.
+
+    This is a view onto a NodeStore, nodes are equal if they are the same entry in the same store.
     """
+    __slots__ = ('_store', '_index')
 
-    def __init__(self, ref_id: str, latitude: float, longitude: float):
-        self._ref_id = ref_id
-        self._latitude = float(latitude)
-        self._longitude = float(longitude)
-        self._routes: T.Set[str] = set()
+    def __init__(self, store: NodeStore, index: int):
+        self._store = store
+        self._index = index
 
     def __repr__(self) -> str:
         return f"Node({self.ref_id} - {self.lat}, {self.lon})"
 
-    def add_route(self, route: str) -> None:
-        self._routes.add(route)
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Node) and self._index == other._index and self._store is other._store
+
+    def __hash__(self) -> int:
+        return self._index
+
+    @property
+    def index(self) -> int:
+        return self._index
 
     @property
     def ref_id(self) -> str:
-        return self._ref_id
+        return self._store.ref_ids[self._index]
 
     @property
     def latitude(self) -> float:
-        return self._latitude
+        return self._store.lats[self._index]
 
     @property
     def lat(self) -> float:
-        return self._latitude
+        return self._store.lats[self._index]
 
     @property
     def longitude(self) -> float:
-        return self._longitude
+        return self._store.lons[self._index]
 
     @property
     def lon(self) -> float:
-        return self._longitude
+        return self._store.lons[self._index]
 
     @property
-    def routes(self) -> T.Set[str]:
-        return self._routes
+    def routes(self) -> T.FrozenSet[str]:
+        # nothing ever tagged nodes with routes, kept so callers don't break
+        return frozenset()
+
+
+class _LegacyNode:
+    """
+    Stand-in for the Node class that map caches used to be pickled with, so they still load.
+    """
+
+
+class _MapUnpickler(pickle.Unpickler):
+
+    def find_class(self, module: str, name: str):
+        # old caches were mostly written from generate_routes run as a script
+        if name == "Node" and module in ("__main__", __name__):
+            return _LegacyNode
+        return super().find_class(module, name)
+
+
+def read_graph(filename: str) -> nx.Graph:
+    """
+    Read a pickled graph, including ones keyed by the old Node objects.
+    """
+    with open(filename, 'rb') as infile:
+        return _MapUnpickler(infile).load()
+
+
+def landmark_table(count: int, size: int) -> T.List[array]:
+    """
+    One array of distances per landmark, indexed by node. NaN means not known.
+    """
+    return [array('f', [math.nan]) * size for _ in range(count)]
+
+
+class ShortestPathTree:
+    """
+    Every shortest path leading into a single target node.
+
+    Roads are undirected, so this is the Dijkstra tree grown out from the target. Any number of
+    pursuers can look up their next hop and remaining distance in constant time.
+    """
+
+    def __init__(self, store: NodeStore, target: int, next_hops: T.Dict[int, int], distances: T.Dict[int, float]):
+        self._store = store
+        self._target = target
+        self._next_hops = next_hops
+        self._distances = distances
+        self._created_at = time.time()
+
+    @property
+    def target(self) -> Node:
+        return Node(self._store, self._target)
+
+    @property
+    def age(self) -> float:
+        return time.time() - self._created_at
+
+    def next_hop(self, node: Node) -> T.Optional[Node]:
+        """
+        Get the next node on the way to the target. None at the target or if it can't be reached.
+        """
+        next_hop = self._next_hops.get(node.index)
+        return None if next_hop is None else Node(self._store, next_hop)
+
+    def distance(self, node: Node) -> float:
+        """
+        Road distance (in edge weight units) from a node to the target, inf if it can't be reached.
+        """
+        return self._distances.get(node.index, float('inf'))
+
+    def path(self, node: Node) -> T.List[Node]:
+        if node.index not in self._distances:
+            return []
+        path = [node.index]
+        while path[-1] != self._target:
+            path.append(self._next_hops[path[-1]])
+        return [Node(self._store, idx) for idx in path]
 
 
 class Map:
     """
     Represents roads on a map.
 
-    Generally want to null-initialize.
+    Generally want to null-initialize. The graph is keyed by each node's index in the node
+    store, the Nodes handed out are views onto the store.
     """
 
     def __init__(self):
         self._map = nx.Graph()
-        self._nodes: T.Dict[str, Node] = dict()
+        self._store = NodeStore()
+        # indices of the nodes in the graph, rebuilt whenever the graph changes
+        self._graph_nodes: T.Optional[T.List[int]] = None
+        # graph nodes by grid cell, and the node list they were bucketed from
+        self._cells: T.Dict[T.Tuple[int, int], T.List[int]] = dict()
+        self._cells_of: T.Optional[T.List[int]] = None
+        # keyed by target node index, or by whatever key the caller is tracking the target by
+        self._path_trees: T.Dict[T.Union[int, str], ShortestPathTree] = dict()
+        self._path_tree_lock = threading.Lock()
+        # road distance in meters from each landmark to every node, see build_landmarks
+        self._landmarks: T.Optional[T.List[array]] = None
 
     def ingest_file(self, full_path: str) -> None:
         # read all nodes first into the map, keep a copy of them locally as well
@@ -77,17 +227,13 @@ class Map:
         node_elements = root.findall('node')
         for node_element in node_elements:
             node_id = node_element.attrib["id"]
-            if node_id in self._nodes:
+            if node_id in self._store:
                 continue
-            new_node = Node(
-                ref_id=node_id,
-                latitude=node_element.attrib['lat'],
-                longitude=node_element.attrib['lon']
-            )
-            self._map.add_node(new_node)
-            self._nodes[node_id] = new_node
+            idx = self._store.add(node_id, node_element.attrib['lat'], node_element.attrib['lon'])
+            self._map.add_node(idx)
     
         # for each way element, join all nodes and create a path
+        lats, lons = self._store.lats, self._store.lons
         way_elements = root.findall('way')
         for way_element in way_elements:
 
@@ -104,12 +250,11 @@ class Map:
             edges_with_data = []
             node_pairs: T.Iterable[T.Tuple[ET.Element, ET.Element]] = zip(way_element.findall('nd')[:-1], way_element.findall('nd')[1:])
             for e1, e2 in node_pairs:
-                e1_id = e1.attrib['ref']
-                e2_id = e2.attrib['ref']
-                n1 = self._nodes[e1_id]
-                n2 = self._nodes[e2_id]
-                edges_with_data.append((n1, n2, dist_range(n1.lat, n1.lon, n2.lat, n2.lon)))
+                n1 = self._store.index_of(e1.attrib['ref'])
+                n2 = self._store.index_of(e2.attrib['ref'])
+                edges_with_data.append((n1, n2, dist_range(lats[n1], lons[n1], lats[n2], lons[n2])))
             self._map.add_weighted_edges_from(edges_with_data)
+        self._graph_nodes = None
 
     @classmethod
     def create_from_osm_files(cls, *osm_files) -> "Map":
@@ -124,11 +269,12 @@ class Map:
 
         Nodes and edges should both be removed.
         """
-        nodes_to_remove: T.Set[Node] = set()
+        nodes_to_remove: T.Set[int] = set()
         for component in nx.components.connected_components(self._map):
             if len(component) < min_size:
                 nodes_to_remove.update(component)
         self._map.remove_nodes_from(nodes_to_remove)
+        self._graph_nodes = None
 
     def connect_disjoint_or_prune(self, max_dist: float) -> None:
         """
@@ -147,6 +293,7 @@ class Map:
         # try to link primary to all other nodes
         # TODO: i'm sure there's a more clever way to do this but we don't need this to be
         # blazing fast -- taking a few seconds to load is fine
+        lats, lons = self._store.lats, self._store.lons
         other_components.remove(primary)
         for component in other_components:
             min_dist = float('inf')
@@ -154,9 +301,7 @@ class Map:
             node_o = None  # other node
             for o in component:
                 for p in primary:
-                    o: Node = o
-                    p: Node = p
-                    dist = dist_range(o.lat, o.lon, p.lat, p.lon)
+                    dist = dist_range(lats[o], lons[o], lats[p], lons[p])
                     if dist < min_dist:
                         node_p = p
                         node_o = o
@@ -164,66 +309,338 @@ class Map:
             if min_dist < max_dist:
                 # connect the components at their closest points
                 self._map.add_edge(node_p, node_o, weight=min_dist)
-                print(f'Adding edge between {node_p}, {node_o} with dist {min_dist}')
+                print(f'Adding edge between {self.get_node_from_index(node_p)}, {self.get_node_from_index(node_o)} with dist {min_dist}')
             else:
                 # remove the smaller component
                 print(f'Removing smaller component, too far away: {min_dist}')
                 self._map.remove_nodes_from(component)
+        self._graph_nodes = None
 
+    def _get_graph_nodes(self) -> T.List[int]:
+        if self._graph_nodes is None:
+            self._graph_nodes = list(self._map.nodes)
+        return self._graph_nodes
 
     def get_node_from_id(self, ref_id: str) -> Node:
-        return self._nodes[ref_id]
+        return Node(self._store, self._store.index_of(ref_id))
+
+    def get_node_from_index(self, index: int) -> Node:
+        return Node(self._store, index)
 
     def get_neighbors_of_node(self, ref_id: str):
-        ref_node = self._nodes[ref_id]
-        return self._map[ref_node]
+        ref_node = self.get_node_from_id(ref_id)
+        return {Node(self._store, idx): data for idx, data in self._map[ref_node.index].items()}
+
+    def get_weighted_neighbor_indices(self, index: int) -> T.Iterator[T.Tuple[int, float]]:
+        """
+        Iterate over (neighbor index, edge weight) for a node index.
+        """
+        for neighbor, data in self._map[index].items():
+            yield neighbor, data['weight']
+
+    def get_weighted_neighbors(self, node: Node) -> T.Iterator[T.Tuple[Node, float]]:
+        """
+        Iterate over (neighbor, edge weight) for a node.
+        """
+        for neighbor, weight in self.get_weighted_neighbor_indices(node.index):
+            yield Node(self._store, neighbor), weight
+
+    def _get_cells(self) -> T.Dict[T.Tuple[int, int], T.List[int]]:
+        """
+        Graph node indices bucketed by grid cell, rebuilt whenever the graph changes.
+        """
+        nodes = self._get_graph_nodes()
+        if self._cells_of is not nodes:
+            lats, lons = self._store.lats, self._store.lons
+            cells: T.DefaultDict[T.Tuple[int, int], T.List[int]] = defaultdict(list)
+            for idx in nodes:
+                cells[math.floor(lats[idx] / CELL_SIZE), math.floor(lons[idx] / CELL_SIZE)].append(idx)
+            self._cells = dict(cells)
+            self._cells_of = nodes
+        return self._cells
+
+    def build_cell_index(self) -> None:
+        """
+        Bucket nodes by grid cell now rather than on the first closest node lookup.
+        """
+        self._get_cells()
+
+    def get_closest_node_within(self, lat: float, lon: float, max_dist: float) -> T.Optional[Node]:
+        """
+        Return the closest graph node no more than max_dist meters from a point, or None.
+
+        Cells are searched in rings outwards from the point's cell, stopping as soon as no
+        unsearched cell can hold anything closer, so usually only a few cells get looked at.
+        """
+        cells = self._get_cells()
+        lats, lons = self._store.lats, self._store.lons
+        # flat projection around the point, plenty accurate over a few kilometres
+        lon_scale = max(math.cos(math.radians(lat)), 1e-6)
+        cell_meters = CELL_SIZE * METERS_PER_DEGREE * lon_scale
+        center_lat, center_lon = math.floor(lat / CELL_SIZE), math.floor(lon / CELL_SIZE)
+        best = None
+        best_dist = max_dist ** 2
+        max_ring = math.ceil(max_dist / cell_meters)
+        for ring in range(max_ring + 1):
+            # everything past this ring is at least this far away
+            if best is not None and best_dist <= ((ring - 1) * cell_meters) ** 2:
+                break
+            for lat_cell in range(center_lat - ring, center_lat + ring + 1):
+                edge = lat_cell in (center_lat - ring, center_lat + ring)
+                for lon_cell in range(center_lon - ring, center_lon + ring + 1, 1 if edge else 2 * ring):
+                    for idx in cells.get((lat_cell, lon_cell), ()):
+                        dlat = (lats[idx] - lat) * METERS_PER_DEGREE
+                        dlon = (lons[idx] - lon) * METERS_PER_DEGREE * lon_scale
+                        dist = dlat * dlat + dlon * dlon
+                        if dist <= best_dist:
+                            best, best_dist = idx, dist
+        return None if best is None else Node(self._store, best)
 
     def get_closest_node_to_point(self, lat: float, lon: float) -> Node:
         """
         Return the closest graph node to some point.
 
-        TODO: there's smart ways to do this like splitting nodes into cells. We can
-        time this to see how long it takes for reasonably sized maps.
+        Looks in the grid cells around the point first. Points far from every road fall back
+        to ranking all nodes on a flat projection around the point, read straight off the
+        coordinate arrays, which at city scale picks the same node as the geodesic distance.
         """
-        min_dist = float('inf')
-        min_node = None
-        for node in self._nodes.values():
-            dist = dist_range(lat, lon, node.lat, node.lon)
-            if dist < min_dist:
-                min_dist = dist
-                min_node = node
-        return min_node
+        for max_dist in CLOSEST_NODE_SEARCH_RADII:
+            node = self.get_closest_node_within(lat, lon, max_dist)
+            if node is not None:
+                return node
+
+        lats, lons = self._store.lats, self._store.lons
+        scale = math.cos(math.radians(lat))
+        min_idx = min(
+            self._get_graph_nodes(),
+            key=lambda idx: (lats[idx] - lat) ** 2 + ((lons[idx] - lon) * scale) ** 2,
+            default=None,
+        )
+        return None if min_idx is None else Node(self._store, min_idx)
+
+    def get_random_node(self, rng: random.Random = None) -> Node:
+        return Node(self._store, (rng or random).choice(self._get_graph_nodes()))
+
+    def build_landmarks(self, count: int = 16) -> None:
+        """
+        Precompute road distances from a handful of landmark nodes to every node (ALT).
 
-    def get_random_node(self) -> Node:
-        return list(self._nodes.values())[random.randint(0, len(self._nodes) + 1)]
+        Landmarks are picked farthest-first so they end up spread around the edges of the map,
+        which is where they give the tightest bounds. Distances are in meters regardless of
+        what units the edge weights are in. The table is kept on the graph so it is written
+        out and read back with the map cache.
+        """
+        lats, lons = self._store.lats, self._store.lons
+
+        def meters(u: int, v: int, _) -> float:
+            return haversine_meters(lats[u], lons[u], lats[v], lons[v])
+
+        largest = max(nx.components.connected_components(self._map), key=len)
+        landmark = random.choice(list(largest))
+        # the first landmark is the far end of the map from a random node
+        lengths = nx.single_source_dijkstra_path_length(self._map, landmark, weight=meters)
+        landmark = max(lengths, key=lengths.get)
+
+        table = landmark_table(count, len(self._store))
+        closest = {node: float('inf') for node in largest}
+        for idx in range(count):
+            lengths = nx.single_source_dijkstra_path_length(self._map, landmark, weight=meters)
+            distances = table[idx]
+            for node in self._map.nodes:
+                distances[node] = lengths.get(node, float('inf'))
+            for node in largest:
+                closest[node] = min(closest[node], lengths[node])
+            print(f'Landmark {idx + 1}/{count}: {self.get_node_from_index(landmark)}')
+            landmark = max(closest, key=closest.get)
+
+        self._landmarks = table
+        self._map.graph['landmarks'] = table
+
+    def _has_landmarks(self, index: int) -> bool:
+        return (
+            bool(self._landmarks)
+            and index < len(self._landmarks[0])
+            and not math.isnan(self._landmarks[0][index])
+        )
+
+    def estimate_road_distance(self, start_node: Node, end_node: Node) -> T.Tuple[float, float]:
+        """
+        Get (lower bound, upper bound) on the road distance in meters between two nodes.
+
+        Both bounds are inf if the nodes can't reach each other. Without a landmark table the
+        bounds are just the straight line distance and inf.
+        """
+        straight_line = haversine_meters(start_node.lat, start_node.lon, end_node.lat, end_node.lon)
+        start, end = start_node.index, end_node.index
+        if not self._has_landmarks(start) or not self._has_landmarks(end):
+            return straight_line, float('inf')
+
+        lower = straight_line
+        upper = float('inf')
+        for distances in self._landmarks:
+            d_start = distances[start]
+            d_end = distances[end]
+            if math.isinf(d_start) != math.isinf(d_end):
+                # one of them can get to the landmark and the other can't
+                return float('inf'), float('inf')
+            if math.isinf(d_start):
+                continue
+            lower = max(lower, abs(d_start - d_end))
+            upper = min(upper, d_start + d_end)
+        return lower, upper
+
+    def get_road_distances_within(self, start_node: Node, max_dist: float) -> T.Dict[int, float]:
+        """
+        Get the road distance in meters to every node index within max_dist of a node.
+
+        Distances are settled in order, nearest first.
+        """
+        lats, lons = self._store.lats, self._store.lons
+        start = start_node.index
+        dist: T.Dict[int, float] = {start: 0.0}
+        settled: T.Dict[int, float] = dict()
+        heap = [(0.0, start)]
+        while heap:
+            d, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled[node] = d
+            for neighbor, _ in self.get_weighted_neighbor_indices(node):
+                nd = d + haversine_meters(lats[node], lons[node], lats[neighbor], lons[neighbor])
+                if nd <= max_dist and nd < dist.get(neighbor, float('inf')):
+                    dist[neighbor] = nd
+                    heapq.heappush(heap, (nd, neighbor))
+        return settled
+
+    def get_random_node_in_band(
+        self,
+        start_node: Node,
+        min_dist: float = 0.0,
+        max_dist: float = float('inf'),
+        attempts: int = 256,
+        rng: random.Random = None,
+    ) -> Node:
+        """
+        Pick a random node between min_dist and max_dist meters away by road.
+
+        Random candidates are checked against the landmark bounds first, and one whose bounds
+        both fall inside the band is taken right away. If none turns up, the band gets searched
+        with a Dijkstra from the start capped at max_dist, so the pick is in the band whenever
+        any reachable node is. If none is, the reachable node closest to the band is used, or
+        the candidate whose bounds came closest to the band if nothing is reachable.
+
+        With no upper limit the straight line distance is enough to prove a candidate is far
+        enough away, and the candidate that came closest is used if none is.
+        """
+        rng = rng or random
+        nodes = self._get_graph_nodes()
+        best = None
+        best_miss = None
+        for _ in range(attempts):
+            candidate = Node(self._store, rng.choice(nodes))
+            lower, upper = self.estimate_road_distance(start_node, candidate)
+            if math.isinf(lower):
+                continue
+            if lower >= min_dist and upper <= max_dist:
+                return candidate
+            # rank the rest by how far their bounds sit outside the band, then by how much
+            # of the bounds overlap it
+            gap = max(lower - max_dist, min_dist - upper, 0.0)
+            overlap = max(min(upper, max_dist) - max(lower, min_dist), 0.0)
+            miss = (gap, -overlap / (upper - lower) if upper > lower else 0.0)
+            if best_miss is None or miss < best_miss:
+                best, best_miss = candidate, miss
+
+        if math.isinf(max_dist):
+            return best or Node(self._store, rng.choice(nodes))
+
+        distances = self.get_road_distances_within(start_node, max_dist)
+        in_band = [idx for idx, dist in distances.items() if dist >= min_dist and idx != start_node.index]
+        if in_band:
+            return Node(self._store, rng.choice(in_band))
+        if len(distances) > 1:
+            # nothing reachable is far enough, go as far as we can
+            return Node(self._store, next(reversed(distances)))
+        return best or Node(self._store, rng.choice(nodes))
 
     def get_shortest_route_between_points(self, start_node: Node, end_node: Node) -> T.List[Node]:
         """
         Get a list of nodes that make up the shortest path between two nodes.
         """
-        if start_node not in self._nodes.values():
+        if start_node.index not in self._map:
             raise ValueError("Start node not in graph nodes")
-        if end_node not in self._nodes.values():
+        if end_node.index not in self._map:
             raise ValueError("End node not in graph nodes")
 
         try:
-            return shortest_path(self._map, start_node, end_node, 'weight')
+            path = shortest_path(self._map, start_node.index, end_node.index, 'weight')
         except nx.NetworkXNoPath:
             return []
+        return [Node(self._store, idx) for idx in path]
+
+    def get_shortest_path_tree(self, target: Node, max_age: float) -> ShortestPathTree:
+        """
+        Get the shortest path tree into a target, shared by everything chasing that target.
+
+        Trees are cached by target node and rebuilt once they are older than max_age, so the cost
+        is one Dijkstra per target per repath period no matter how many pursuers there are.
+        """
+        with self._path_tree_lock:
+            tree = self._path_trees.get(target.index)
+            if tree is not None and tree.age < max_age:
+                return tree
+            return self._build_path_tree(target, target.index, max_age)
+
+    def get_shortest_path_tree_to_point(self, key: str, latitude: float, longitude: float, max_age: float) -> ShortestPathTree:
+        """
+        Get the shortest path tree into the node closest to a point, cached by key (e.g. the
+        device ID of the player being chased).
+
+        The point only gets snapped when the tree is rebuilt, so every pursuer of the same
+        player follows the same tree and it costs one Dijkstra per player per repath period,
+        even if the pursuers last saw the player at slightly different spots.
+        """
+        with self._path_tree_lock:
+            tree = self._path_trees.get(key)
+            if tree is not None and tree.age < max_age:
+                return tree
+            target = self.get_closest_node_to_point(latitude, longitude)
+            return self._build_path_tree(target, key, max_age)
+
+    def _build_path_tree(self, target: Node, key: T.Union[int, str], max_age: float) -> ShortestPathTree:
+        # drop trees nobody has refreshed, targets move around a lot
+        for stale in [k for k, v in self._path_trees.items() if v.age >= max_age]:
+            del self._path_trees[stale]
+
+        preds, distances = dijkstra_predecessor_and_distance(self._map, target.index, weight='weight')
+        next_hops = {node: pred[0] for node, pred in preds.items() if pred}
+        tree = ShortestPathTree(self._store, target.index, next_hops, distances)
+        self._path_trees[key] = tree
+        return tree
 
     @classmethod
     def read_from_cache(cls, filename: str) -> "Map":
         """Read a map file from cache"""
-        graph: nx.Graph = nx.read_gpickle(filename)
+        graph = read_graph(filename)
         map = Map()
-        map._map = graph
-        map._nodes = {x.ref_id: x for x in graph.nodes}
+        if 'nodes' in graph.graph:
+            map._store = NodeStore(*graph.graph['nodes'])
+            map._map = graph
+        else:
+            # caches written before the node store are keyed by Node objects
+            map._map = nx.relabel_nodes(graph, {
+                node: map._store.add(node._ref_id, node._latitude, node._longitude)
+                for node in graph.nodes
+            })
+
+        map._landmarks = map._map.graph.get('landmarks')
         return map
 
     def write_to_cache(self, filename: str) -> None:
         """
         The graph should contain everything needed to load the Map object
         """
+        self._map.graph['nodes'] = self._store.state()
         nx.write_gpickle(self._map, filename)
 
 
@@ -235,6 +652,9 @@ def get_parser() -> argparse.ArgumentParser:
     cache_group = parser.add_mutually_exclusive_group()
     cache_group.add_argument("--write-to-cache", action="store_true")
     cache_group.add_argument("--read-from-cache", action="store_true")
+    parser.add_argument("--landmarks", type=int, default=0, help="precompute a landmark distance table with this many landmarks")
+    parser.add_argument("--write-tiles", action="store_true", help="also write the map as lazily loaded tiles")
+    parser.add_argument("--tile-size", type=float, default=0.01, help="tile edge length in degrees")
     return parser
 
 
@@ -257,11 +677,22 @@ def main() -> None:
     map.prune_components(args.prune_disjoint)
     map.connect_disjoint_or_prune(args.connect_disjoint)
 
+    if args.landmarks:
+        print(f'Building {args.landmarks} landmarks')
+        map.build_landmarks(args.landmarks)
+
     filename = os.path.join(OSM_DIR, args.region, "map.gpickle")
     if args.write_to_cache:
         print(f'Writing map to cache at {filename}')
         map.write_to_cache(filename)
 
+    if args.write_tiles:
+        from src.tiled_map import TILE_DIR
+        from src.tiled_map import write_tiles
+        tile_dir = os.path.join(OSM_DIR, args.region, TILE_DIR)
+        print(f'Writing map tiles to {tile_dir}')
+        write_tiles(map, tile_dir, args.tile_size)
+
     import IPython; IPython.embed()
 
 
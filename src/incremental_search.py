@@ -0,0 +1,165 @@
+"""
+Incremental shortest paths for bots chasing a moving target over the road graph.
+"""
+import heapq
+import itertools
+import typing as T
+from collections import defaultdict
+
+from src.generate_routes import Map
+from src.generate_routes import Node
+from src.util.distance import dist_range
+
+
+# if a local snap lands further than this from the requested point, fall back to a full scan
+MAX_SNAP_ERROR_METERS = 150.0
+
+
+class IncrementalPathfinder:
+    """
+    Dijkstra search tree rooted at a seeker that is kept alive between repaths.
+
+    This follows the fringe-retrieving approach from moving target search:
+     * when the target moves to a node that has already been settled, the path comes straight
+       out of the parent pointers. If it moves outside the settled area, the search only
+       expands the ring between the old and new frontier.
+     * when the seeker advances along its path to a settled node, the subtree under that node is
+       still a valid shortest path tree (subpaths of shortest paths are shortest). Only the
+       discarded part of the old tree is walked to rebuild the open list around the kept subtree.
+
+    Either way repath cost scales with how far things moved rather than with the size of the map.
+    """
+
+    def __init__(self, map: Map, root: Node):
+        self._map = map
+        self._counter = itertools.count()
+        self._reset(root)
+
+    def _reset(self, root: Node) -> None:
+        self._root = root
+        # the tree is kept in node indices, see NodeStore
+        # distances are stored relative to the original root and shifted by the offset on read,
+        # so moving the root never has to touch the kept part of the tree
+        self._offset = 0.0
+        self._dist: T.Dict[int, float] = {root.index: 0.0}
+        self._parent: T.Dict[int, T.Optional[int]] = {root.index: None}
+        self._children: T.DefaultDict[int, T.Set[int]] = defaultdict(set)
+        self._closed: T.Set[int] = set()
+        self._open: T.List[T.Tuple[float, int, int]] = [(0.0, next(self._counter), root.index)]
+        self.expansions = 0
+
+    @property
+    def root(self) -> Node:
+        return self._root
+
+    def _relax(self, parent: int, node: int, dist: float) -> None:
+        if dist >= self._dist.get(node, float('inf')):
+            return
+        old_parent = self._parent.get(node)
+        if old_parent is not None:
+            self._children[old_parent].discard(node)
+        self._parent[node] = parent
+        self._children[parent].add(node)
+        self._dist[node] = dist
+        heapq.heappush(self._open, (dist, next(self._counter), node))
+
+    def _expand_until(self, target: int) -> None:
+        while target not in self._closed and self._open:
+            dist, _, node = heapq.heappop(self._open)
+            if node in self._closed or self._dist.get(node) != dist:
+                # stale heap entry
+                continue
+            self._closed.add(node)
+            self.expansions += 1
+            for neighbor, weight in self._map.get_weighted_neighbor_indices(node):
+                if neighbor not in self._closed:
+                    self._relax(node, neighbor, dist + weight)
+
+        # stale entries pile up after root moves, compact every so often
+        if len(self._open) > 4 * len(self._dist) + 64:
+            self._open = [x for x in self._open if x[2] not in self._closed and self._dist.get(x[2]) == x[0]]
+            heapq.heapify(self._open)
+
+    def distance_to(self, target: Node) -> float:
+        """
+        Road distance (in edge weight units) from the root to the target, inf if unreachable.
+        """
+        self._expand_until(target.index)
+        if target.index not in self._closed:
+            return float('inf')
+        return self._dist[target.index] - self._offset
+
+    def path_to(self, target: Node) -> T.List[Node]:
+        """
+        Get the shortest path from the root to the target, inclusive of both ends.
+
+        Returns an empty list if the target can't be reached.
+        """
+        self._expand_until(target.index)
+        if target.index not in self._closed:
+            return []
+        path = []
+        node = target.index
+        while node is not None:
+            path.append(self._map.get_node_from_index(node))
+            node = self._parent[node]
+        return path[::-1]
+
+    def move_root(self, new_root: Node) -> None:
+        """
+        Re-root the search at a new seeker position, keeping whatever part of the tree is still valid.
+        """
+        if new_root == self._root:
+            return
+        if new_root.index not in self._closed:
+            # nothing to salvage
+            self._reset(new_root)
+            return
+
+        # detach the new root, then everything still reachable from the old root is stale
+        old_parent = self._parent[new_root.index]
+        self._children[old_parent].discard(new_root.index)
+        self._parent[new_root.index] = None
+
+        discarded = []
+        stack = [self._root.index]
+        while stack:
+            node = stack.pop()
+            discarded.append(node)
+            stack.extend(self._children.pop(node, ()))
+        for node in discarded:
+            del self._dist[node]
+            del self._parent[node]
+            self._closed.discard(node)
+
+        self._root = new_root
+        self._offset = self._dist[new_root.index]
+
+        # retrieve the fringe: discarded nodes that border the kept tree go back on the open list
+        for node in discarded:
+            for neighbor, weight in self._map.get_weighted_neighbor_indices(node):
+                if neighbor in self._closed:
+                    self._relax(neighbor, node, self._dist[neighbor] + weight)
+
+
+def snap_near(map: Map, hint: Node, latitude: float, longitude: float) -> Node:
+    """
+    Find the graph node closest to a point, starting from a node that is probably nearby.
+
+    Walks downhill from the hint so a target that moved a little costs a handful of distance
+    checks instead of a scan over every node. Dead ends can trap the walk, so a snap that is
+    still far from the point falls back to the full search.
+    """
+    best = hint
+    best_dist = dist_range(latitude, longitude, hint.lat, hint.lon)
+    improved = True
+    while improved:
+        improved = False
+        for neighbor, _ in map.get_weighted_neighbors(best):
+            dist = dist_range(latitude, longitude, neighbor.lat, neighbor.lon)
+            if dist < best_dist:
+                best, best_dist = neighbor, dist
+                improved = True
+    if best_dist > MAX_SNAP_ERROR_METERS:
+        return map.get_closest_node_to_point(latitude, longitude)
+    return best
@@ -0,0 +1,150 @@
+"""
+Ramble bot movement, without any clock or publishing.
+
+This is shared by the live ramble bot, which sleeps between positions and publishes them, and
+the offline simulator, which steps through positions against a virtual clock.
+"""
+import random
+import typing as T
+from collections import deque
+
+from src.generate_routes import Map
+from src.util.distance import get_delta_between_points
+from src.util.distance import meters_between_points
+
+
+def ramble_positions(
+    map: Map,
+    start_lat: float = None,
+    start_lon: float = None,
+    speed: float = 2.0,  # speed in meters per second
+    broadcast_period: float = 1.0,
+    min_leg_distance: float = None,
+    max_leg_distance: float = None,
+    rng: random.Random = None,
+    verbose: bool = True,
+) -> T.Generator[T.Tuple[float, float], T.Optional[float], None]:
+    """
+    Yield a ramble bot's position once per broadcast period, forever.
+
+    Send the number of seconds until the next position is wanted to step by something other
+    than the broadcast period. Whatever is left of a step after reaching a waypoint carries
+    on towards the next one, so long steps cover the same ground as several short ones.
+
+    Ramble Bot Rules:
+     * strongly prefer not visiting the same spot again, but if there are no choices, it's fine.
+     * ramble bots start by walking to the nearest road point
+     * afterwards, ramble bots will pick a random neighbor to start traversing towards and
+       set that as the next waypoint
+     * when the bot closes proximity with a waypoint to within 10m, it will pick the next waypoint
+       if there is one enqueued, or it will enqueue itself a new one.
+     * if a leg distance band is given, new destinations are picked to be roughly that far away
+       by road, using the map's landmark bounds.
+
+    All randomness comes from `rng`, so a seeded rng replays the same walk on the same map.
+    """
+    def _print(msg: str) -> None:
+        if verbose:
+            print(msg)
+
+    rng = rng or random.Random()
+
+    # waypoints are a double ended queue
+    # traversal algorithm pops from right, can insert to left to add additional waypoints
+    waypoints: T.Deque[str] = deque()
+
+    # do not allow cycles unless there are no other options
+    seen_waypoints: T.Dict[str, int] = dict()  # use node IDs to keep track
+
+    # initial position, not the start route position
+    node = None
+
+    # if we have a start point, use that
+    if start_lat is not None and start_lon is not None:
+        # we start by walking to the closest node to our start point
+        start = map.get_closest_node_to_point(start_lat, start_lon)
+        pos = (start_lat, start_lon)
+        waypoints.append(start.ref_id)
+    # otherwise pick a random node
+    else:
+        start = map.get_random_node(rng=rng)
+        pos = (start.lat, start.lon)
+        # already on the map, no need to search for the closest node
+        node = start
+
+    _print(f'Ramble bot proceeding to ({start.lat}, {start.lon}) first')
+
+    def _elapsed(sent: T.Optional[float]) -> float:
+        return broadcast_period if sent is None else sent
+
+    waypoint = None
+    waypoint_count = 0
+    # meters left to travel before the next position goes out
+    remaining = speed * broadcast_period
+    while True:
+
+        # Enqueue New Waypoint
+        if not waypoints:
+            # enqueue new ramble waypoint here, typically the next neighbor node
+            if node is None:  # safe to just use this usually
+                node = map.get_closest_node_to_point(*pos)
+
+            # find a new point on the map to travel to
+            idx = 0
+            while True:
+                idx += 1
+                if idx > 30:
+                    # ok we give up just go next
+                    node = map.get_random_node(rng=rng)
+
+                if min_leg_distance is None and max_leg_distance is None:
+                    new_waypoint = map.get_random_node(rng=rng)
+                else:
+                    new_waypoint = map.get_random_node_in_band(
+                        node,
+                        min_leg_distance or 0.0,
+                        max_leg_distance or float('inf'),
+                        rng=rng,
+                    )
+                # figure out the path to that new waypoint
+                path_to_new_waypoint = map.get_shortest_route_between_points(node, new_waypoint)[1:]
+                if not path_to_new_waypoint:
+                    _print('Warning: random point is not connected')
+                    continue
+
+                _print(f'Adding waypoints: {path_to_new_waypoint}')
+                for path_point in path_to_new_waypoint:
+                    waypoints.append(path_point.ref_id)
+                break
+
+        # Pop Waypoint
+        if waypoint is None:
+            # tell the loop to get the next waypoint
+            waypoint = waypoints.popleft()
+            node = map.get_node_from_id(waypoint)
+            waypoint_count += 1
+            seen_waypoints[waypoint] = waypoint_count
+
+            # we have a chance of stopping at this point for some period of time
+            # TODO: make this configurable
+            if rng.random() < 0.01:
+                wait = rng.randint(15, 120)
+                _print(f'We are taking a break here for {wait}s')
+                while wait > 0:
+                    wait -= _elapsed((yield pos))
+                # we get going again partway through the last step
+                remaining = -wait * speed
+
+        # TODO: turn this into heading and velocity
+        meters_to_node = meters_between_points(*pos, node.lat, node.lon)
+        if meters_to_node <= remaining:
+            # reached, carry the rest of the step on to the next waypoint
+            pos = (node.lat, node.lon)
+            remaining -= meters_to_node
+            waypoint = None
+            continue
+
+        # start moving towards waypoint
+        delta, _ = get_delta_between_points(remaining, *pos, node.lat, node.lon)
+        pos = (pos[0] + delta[0], pos[1] + delta[1])
+        remaining = speed * _elapsed((yield pos))
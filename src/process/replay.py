@@ -0,0 +1,76 @@
+"""
+Stream precomputed trajectories (see src.process.simulate) to MQTT.
+
+Every bot in the file gets checked out as an ambient bot, then each tick's positions are
+published on the tick's wall clock schedule. Replaying costs one publish per bot per tick and
+no map or routing work.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import time
+
+from src.process.run_bot import BACKEND_URL
+from src.process.run_bot import BotProfile
+from src.process.run_bot import check_in_bots
+from src.process.run_bot import check_out_bots
+from src.process.run_bot import publish_location
+from src.util.trajectory import TrajectoryReader
+
+
+def replay(
+    filename: str,
+    region: str = None,
+    backend_url: str = BACKEND_URL,
+    masquerade_as: str = "",
+    loop: bool = False,
+    duration: float = None,
+) -> None:
+    reader = TrajectoryReader(filename)
+    print(f'Replaying {reader.bot_count} bots x {reader.tick_count} ticks from {filename}')
+    bot_ids = check_out_bots(BotProfile.RAMBLE, masquerade_as, backend_url, reader.bot_count)
+    try:
+        start = time.time()
+        next_tick = start
+        while True:
+            for positions in reader.ticks():
+                if duration is not None and time.time() - start >= duration:
+                    return
+                for bot_id, (lat, lon) in zip(bot_ids, positions):
+                    publish_location(bot_id, lat, lon, region=region)
+                # schedule off the start time so publishing doesn't make us drift
+                next_tick += reader.period
+                time.sleep(max(next_tick - time.time(), 0.0))
+            if not loop:
+                return
+    finally:
+        check_in_bots(bot_ids, backend_url)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trajectory", help="trajectory file written by src.process.simulate")
+    parser.add_argument("--region", help="region to partition location topics by")
+    parser.add_argument("--backend-url", default=BACKEND_URL)
+    parser.add_argument("--masquerade-as", default="")
+    parser.add_argument("--loop", action="store_true", help="start over from the first tick when the file runs out")
+    parser.add_argument("--duration", type=float, help="if specified, how long to replay for")
+    return parser
+
+
+def main() -> None:
+    parser = get_parser()
+    args = parser.parse_args()
+    replay(
+        args.trajectory,
+        region=args.region,
+        backend_url=args.backend_url,
+        masquerade_as=args.masquerade_as,
+        loop=args.loop,
+        duration=args.duration,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -7,8 +7,6 @@ monkey.patch_all()
 import argparse
 import json
 import os
-import random
-import requests
 import signal
 import threading
 import time
@@ -20,22 +18,35 @@ from pydantic import BaseModel
 
 from src.generate_routes import Map
 from src.generate_routes import Node
+from src.incremental_search import IncrementalPathfinder
+from src.incremental_search import snap_near
+from src.process.ramble import ramble_positions
+from src.region_index import RegionIndex
+from src.tiled_map import load_map
+from src.util.backend import get_backend_client
 from src.util.distance import get_delta_between_points
-from src.util.distance import dist_range
 from src.util.distance import meters_between_points
-from src.util.mqtt import CLIENT
+from src.util.location_codec import encode_location
+from src.util.location_codec import location_topic
+from src.util.location_codec import LOCATION_REMOVE_TOPIC
+from src.util.location_cache import get_position
+from src.util.mqtt import publish
 from src.util.osm_dir import OSM_DIR
-
-# this is needed to fix namespacing for pickle
-import sys
-sys.modules['__main__'].Node = Node
+from src.util.proximity import get_monitor
 
 
 BOT_ID = None
 BACKEND_URL = "https://urbanrace.fugitive.link"
 
+# removal messages get sent a few times, a second apart
+REMOVAL_REPEATS = 3
+REMOVAL_INTERVAL = 1.0
+# max number of ids packed into a single removal message
+REMOVAL_BATCH_SIZE = 500
+
 
-MAP_CACHE = {region: Map.read_from_cache(os.path.join(OSM_DIR, region, "map.gpickle")) for region in os.listdir(OSM_DIR)}
+MAP_CACHE = {region: load_map(os.path.join(OSM_DIR, region)) for region in os.listdir(OSM_DIR)}
+REGION_INDEX = RegionIndex.from_maps(MAP_CACHE)
 
 
 class BotProfile(int, Enum):
@@ -58,7 +69,12 @@ def get_parser() -> argparse.ArgumentParser:
     parser.add_argument("--speed", type=float, default=1.5)  # walking speed
     parser.add_argument("--broadcast-period", type=float, default=3.0, help="default only broadcast a location every 1s")
     parser.add_argument("--duration", type=float, help="if specified, how long to run the bot for. If not specified, run forever.")
-    parser.add_argument("--repath-period", default=5.0, help="how often to recalculate trajectory")
+    parser.add_argument("--repath-period", type=float, default=5.0, help="how often to recalculate trajectory")
+    parser.add_argument("--target", default="", help="device ID of the player to hunt")
+    parser.add_argument("--min-leg-distance", type=float, help="ramble bots pick destinations at least this many meters away by road")
+    parser.add_argument("--max-leg-distance", type=float, help="ramble bots pick destinations at most this many meters away by road")
+    parser.add_argument("--adaptive-broadcast", action="store_true", help="broadcast less often when no player is nearby")
+    parser.add_argument("--shared-path-tree", action="store_true", help="follow a path tree shared with other bots hunting the same target")
     return parser
 
 
@@ -84,49 +100,115 @@ def check_out_bot(profile: BotProfile, masquerade_as: str, backend_url: str) ->
 
     Returns the bot ID if successful. Throws exception if not.
     """
-    bot_type = map_bot_type(profile)
-    resp = requests.post(f"{backend_url}/api/bots/check_out", json={'bot_type': bot_type, 'masquerade_as': masquerade_as})
-    resp.raise_for_status()
+    return get_backend_client(backend_url).check_out(map_bot_type(profile), masquerade_as)
+
+
+def check_out_bots(profile: BotProfile, masquerade_as: str, backend_url: str, count: int) -> T.List[str]:
+    """
+    Check out several bots at once. Either all of them get checked out or this throws.
+    """
+    return get_backend_client(backend_url).check_out_many(map_bot_type(profile), masquerade_as, count)
 
-    return json.loads(resp.text)["bot_id"]
 
+def publish_removal(bot_ids: T.Iterable[str]) -> None:
+    """
+    Tell clients to drop some bots.
 
-def check_in_bot(bot_id: str) -> None:
-    msg = dict(
+    The message gets repeated a few times because networking sucks, but the repeats go out in
+    the background so the caller doesn't wait on them.
+    """
+    payload = json.dumps(dict(
         transactionId=-1,
-        idsToRemove=[bot_id]
-    )
-    cts = 0
-    while cts < 3:
-        CLIENT.publish("gamestate-Location-Remove", json.dumps(msg))
-        time.sleep(1.00)  # wow networking sucks
-        cts += 1
-    resp = requests.post(f"{BACKEND_URL}/api/bots/check_in", json={'bot_id': bot_id})
-    resp.raise_for_status()
+        idsToRemove=list(bot_ids)
+    ))
+    publish(LOCATION_REMOVE_TOPIC, payload)
+    for idx in range(1, REMOVAL_REPEATS):
+        timer = threading.Timer(idx * REMOVAL_INTERVAL, publish, args=(LOCATION_REMOVE_TOPIC, payload))
+        timer.daemon = True
+        timer.start()
+
+
+def check_in_bot(bot_id: str, backend_url: str = None) -> None:
+    publish_removal([bot_id])
+    get_backend_client(backend_url or BACKEND_URL).check_in(bot_id)
+
+
+def check_in_bots(bot_ids: T.Iterable[str], backend_url: str = None) -> T.List[str]:
+    """
+    Remove and check in several bots at once. Returns the IDs the backend failed to check in.
+    """
+    bot_ids = list(bot_ids)
+    for idx in range(0, len(bot_ids), REMOVAL_BATCH_SIZE):
+        publish_removal(bot_ids[idx:idx + REMOVAL_BATCH_SIZE])
+    return get_backend_client(backend_url or BACKEND_URL).check_in_many(bot_ids)
+
+
+class BotControl:
+    """
+    Lets whoever started a bot stop it from another thread.
+
+    If the bot was already checked in on its behalf (e.g. as part of a bulk teardown), or was
+    handed over to another instance, `checked_in` is set so the bot doesn't check itself in on
+    the way out.
+    """
+
+    def __init__(self, region: str = None):
+        self.region = region
+        self.stop = threading.Event()
+        self.bot_id: T.Optional[str] = None
+        self.checked_in = False
+
+
+def is_stopped(stop: T.Optional[threading.Event]) -> bool:
+    return stop is not None and stop.isSet()
+
+
+def sleep_unless_stopped(period: float, stop: T.Optional[threading.Event]) -> None:
+    if stop is None:
+        time.sleep(period)
+    else:
+        stop.wait(period)
 
 
 @contextmanager
-def bot_context(profile: BotProfile, masquerade_as: str, backend_url: str) -> T.Iterator[str]:
-    bot_id = None
+def bot_context(
+    profile: BotProfile,
+    masquerade_as: str,
+    backend_url: str,
+    bot_id: str = None,
+    control: BotControl = None,
+) -> T.Iterator[str]:
+    """
+    Check a bot out for the duration of the context. Pass a bot ID to resume a bot that is
+    already checked out.
+    """
     try:
-        bot_id = check_out_bot(profile, masquerade_as, backend_url)
+        if bot_id is None:
+            bot_id = check_out_bot(profile, masquerade_as, backend_url)
+        if control is not None:
+            control.bot_id = bot_id
         yield bot_id
     finally:
-        if bot_id is not None:
-            check_in_bot(bot_id)
+        if bot_id is not None and (control is None or not control.checked_in):
+            check_in_bot(bot_id, backend_url)
 
 
-def fmt_location_message(client_id: str, latitude: float, longitude: float) -> T.Dict:
-    return dict(
-        transactionId=-1,
-        entity=dict(
-            uuid=client_id,
-            device_id=f"BOT-{client_id}",
-            timestamp=time.time(),
-            pos_lat=latitude,
-            pos_lon=longitude,
-        )
-    )
+def publish_location(bot_id: str, latitude: float, longitude: float, region: str = None) -> None:
+    """
+    Publish a bot location using the configured wire encoding and topic partitioning.
+    """
+    topic = location_topic(region=region, latitude=latitude, longitude=longitude)
+    # shard by bot so each bot's updates stay in order on one connection
+    publish(topic, encode_location(bot_id, latitude, longitude), key=bot_id)
+
+
+def get_broadcast_period(broadcast_period: float, latitude: float, longitude: float, adaptive: bool = False) -> float:
+    """
+    How long to wait before the next broadcast. Adaptive bots back off when no player is near.
+    """
+    if not adaptive:
+        return broadcast_period
+    return get_monitor().broadcast_period(latitude, longitude, broadcast_period)
 
 
 def setup_shutdown_timer(duration: T.Optional[float], off_event: threading.Event):
@@ -137,14 +219,22 @@ def setup_shutdown_timer(duration: T.Optional[float], off_event: threading.Event
     timer.start()
 
 
-def do_stationary_bot(bot_id: str, lat: float, lon: float, duration: float = None, broadcast_period: float = 1.0):
+def do_stationary_bot(
+    bot_id: str,
+    lat: float,
+    lon: float,
+    duration: float = None,
+    broadcast_period: float = 1.0,
+    region: str = None,
+    stop: threading.Event = None,
+    adaptive_broadcast: bool = False,
+):
     off = threading.Event()
     setup_shutdown_timer(duration, off)
 
-    while not off.isSet():
-        msg_dict = fmt_location_message(bot_id, lat, lon)
-        CLIENT.publish("gamestate-Location-Update", json.dumps(msg_dict))
-        time.sleep(broadcast_period)
+    while not off.isSet() and not is_stopped(stop):
+        publish_location(bot_id, lat, lon, region=region)
+        sleep_unless_stopped(get_broadcast_period(broadcast_period, lat, lon, adaptive_broadcast), stop)
 
 
 def do_ramble_bot(
@@ -155,16 +245,71 @@ def do_ramble_bot(
     speed: float = 2.0,  # speed in meters per second
     duration: float = None,
     broadcast_period: float = 1.0,
-    verbose: bool = True
+    verbose: bool = True,
+    region: str = None,
+    stop: threading.Event = None,
+    min_leg_distance: float = None,
+    max_leg_distance: float = None,
+    adaptive_broadcast: bool = False,
+):
+    """
+    Walk the map following the ramble rules (see ramble_positions), publishing a position
+    every broadcast period, or less often if adaptive and no player is near.
+    """
+    off = threading.Event()
+    setup_shutdown_timer(duration, off)
+
+    positions = ramble_positions(
+        map,
+        start_lat,
+        start_lon,
+        speed=speed,
+        broadcast_period=broadcast_period,
+        min_leg_distance=min_leg_distance,
+        max_leg_distance=max_leg_distance,
+        verbose=verbose,
+    )
+    period = None
+    while not off.isSet() and not is_stopped(stop):
+        # step by however long we actually waited since the last position
+        pos = positions.send(period)
+
+        # create message and push it
+        if verbose:
+            print(pos)
+        publish_location(bot_id, pos[0], pos[1], region=region)
+        period = get_broadcast_period(broadcast_period, *pos, adaptive_broadcast)
+        sleep_unless_stopped(period, stop)
+
+
+def do_hunt_road_bot(
+    bot_id: str,
+    map: Map,
+    target: str,
+    start_lat: float,
+    start_lon: float,
+    speed: float = 2.0,  # speed in meters per second
+    duration: float = None,
+    broadcast_period: float = 1.0,
+    repath_period: float = 5.0,
+    shared_path_tree: bool = False,
+    verbose: bool = True,
+    region: str = None,
+    stop: threading.Event = None,
+    adaptive_broadcast: bool = False,
 ):
     """
-    Ramble Bot Rules:
-     * strongly prefer not visiting the same spot again, but if there are no choices, it's fine.
-     * ramble bots start by walking to the nearest road point
-     * afterwards, ramble bots will pick a random neighbor to start traversing towards and
-       set that as the next waypoint
-     * when the bot closes proximity with a waypoint to within 10m, it will pick the next waypoint
-       if there is one enqueued, or it will enqueue itself a new one.
+    Hunt Bot Rules:
+     * hunt bots start by walking to the nearest road point, or from the road point closest
+       to the target if no start point is given
+     * every repath period, look up where the target is in the location cache and take the
+       shortest road path towards it
+     * if the target can't be found, keep following the last known path
+
+    By default the search tree is kept between repaths (see IncrementalPathfinder) so a seeker
+    chasing a target that moved a few blocks doesn't rerun a full Dijkstra. With a shared path
+    tree, every seeker on the same target reads its next hop off one tree cached on the map,
+    which is cheaper when a pack of seekers is chasing one player.
     """
     def _print(msg: str) -> None:
         if verbose:
@@ -173,106 +318,74 @@ def do_ramble_bot(
     off = threading.Event()
     setup_shutdown_timer(duration, off)
 
-    # waypoints are a double ended queue
-    # traversal algorithm pops from right, can insert to left to add additional waypoints
-    waypoints: T.Deque[str] = deque()
-
-    # do not allow cycles unless there are no other options
-    seen_waypoints: T.Dict[str, int] = dict()  # use node IDs to keep track
-
-    # if we have a start point, use that
-    if start_lat is not None and start_lon is not None:
-        # we start by walking to the closest node to our start point
-        start = map.get_closest_node_to_point(start_lat, start_lon)
-        pos = (start_lat, start_lon)
-        waypoints.append(start.ref_id)
-    # otherwise pick a random node
+    if start_lat is None or start_lon is None:
+        target_pos = get_position(target)
+        if target_pos is None:
+            raise ValueError(f"No start point given and target {target} can't be found")
+        last_node = map.get_closest_node_to_point(*target_pos)
+        pos = (last_node.lat, last_node.lon)
     else:
-        start = map.get_random_node()
-        pos = (start.lat, start.lon)
-
-    _print(f'Ramble bot proceeding to ({start.lat}, {start.lon}) first')
-
-    # initial position, not the start route position
-    node = None
-    waypoint = None
-    waypoint_count = 0
-    while not off.isSet():
-
-        # Enqueue New Waypoint
-        if not waypoints:
-            # enqueue new ramble waypoint here, typically the next neighbor node
-            if node is None:  # safe to just use this usually
-                node = map.get_closest_node_to_point(*pos)
-
-            # find a new point on the map to travel to
-            idx = 0
-            while True:
-                idx += 1
-                if idx > 30:
-                    # ok we give up just go next
-                    node = map.get_random_node()
-
-                new_waypoint = map.get_random_node()
-                # figure out the path to that new waypoint
-                path_to_new_waypoint = map.get_shortest_route_between_points(node, new_waypoint)[1:]
-                if not path_to_new_waypoint:
-                    _print('Warning: random point is not connected')
-                    time.sleep(1.)
-                    continue
-
-                _print(f'Adding waypoints: {path_to_new_waypoint}')
-                for path_point in path_to_new_waypoint:
-                    waypoints.append(path_point.ref_id)
+        pos = (start_lat, start_lon)
+        last_node = map.get_closest_node_to_point(*pos)
+    pathfinder = None if shared_path_tree else IncrementalPathfinder(map, last_node)
+    tree = None
+    target_node = None
+    path: T.Deque[Node] = deque([last_node])
+    last_repath = None
+    period = broadcast_period
+    while not off.isSet() and not is_stopped(stop):
+
+        # Repath
+        now = time.time()
+        if last_repath is None or now - last_repath >= repath_period:
+            last_repath = now
+            target_pos = get_position(target)
+            if target_pos is None:
+                _print(f'Lost track of target {target}')
+            elif shared_path_tree:
+                # snapped once per target per period, so every seeker on it shares one tree
+                tree = map.get_shortest_path_tree_to_point(target, *target_pos, max_age=repath_period)
+                _print(f'Following path tree to {tree.target}, {tree.distance(last_node)} to go')
+            else:
+                if target_node is None:
+                    target_node = map.get_closest_node_to_point(*target_pos)
+                else:
+                    target_node = snap_near(map, target_node, *target_pos)
+                expansions = pathfinder.expansions
+                new_path = pathfinder.path_to(target_node)
+                _print(f'Repathed to {target_node} ({pathfinder.expansions - expansions} expansions)')
+                # if we're already on our way to the next node, don't double back to the root
+                if len(new_path) > 1 and path and new_path[1] == path[0]:
+                    new_path = new_path[1:]
+                path = deque(new_path)
+
+        # Move along the path for however long we waited since the last broadcast
+        remaining = speed * period
+        while remaining > 0:
+            if not path and tree is not None:
+                next_hop = tree.next_hop(last_node)
+                if next_hop is not None:
+                    path.append(next_hop)
+            if not path:
                 break
+            node = path[0]
+            meters_to_node = meters_between_points(*pos, node.lat, node.lon)
+            if meters_to_node <= remaining:
+                pos = (node.lat, node.lon)
+                remaining -= meters_to_node
+                path.popleft()
+                last_node = node
+                if pathfinder is not None:
+                    pathfinder.move_root(node)
+            else:
+                delta, _ = get_delta_between_points(remaining, *pos, node.lat, node.lon)
+                pos = (pos[0] + delta[0], pos[1] + delta[1])
+                remaining = 0
 
-        # Pop Waypoint
-        if waypoint is None:
-            # tell the loop to get the next waypoint
-            waypoint = waypoints.popleft()
-            node = map.get_node_from_id(waypoint)
-            waypoint_count += 1
-            seen_waypoints[waypoint] = waypoint_count
-            # TODO: turn this into heading and velocity
-            meters_to_start = meters_between_points(*pos, node.lat, node.lon)
-            if meters_to_start == 0:
-                continue
-            meters_to_deg = speed * dist_range(*pos, node.lat, node.lon) / meters_to_start
-
-            # we have a chance of stopping at this point for some period of time
-            # TODO: make this configurable
-            if random.random() < 0.01:
-                wait = random.randint(15, 120)
-                _print(f'We are taking a break here for {wait}s')
-                do_stationary_bot(
-                    bot_id,
-                    *pos,
-                    wait,
-                    broadcast_period=broadcast_period
-                )
-
-        if dist_range(*pos, node.lat, node.lon) < 0.00001:
-            # reached, figure out the next waypoint
-            waypoint = None
-            continue
-
-        # start moving towards waypoint
-        dist_moved = meters_to_deg * broadcast_period
-        delta, overshoot = get_delta_between_points(dist_moved, *pos, node.lat, node.lon)
-        # if we're going to overshoot target, just snap to target
-        if overshoot:
-            new_lat, new_lon = node.lat, node.lon
-        else:
-            new_lat = pos[0] + delta[0]
-            new_lon = pos[1] + delta[1]
-
-        pos = (new_lat, new_lon)
-
-        # create message and push it
         _print(pos)
-        msg_dict = fmt_location_message(bot_id, pos[0], pos[1])
-        CLIENT.publish("gamestate-Location-Update", json.dumps(msg_dict))
-        time.sleep(broadcast_period)
+        publish_location(bot_id, pos[0], pos[1], region=region)
+        period = get_broadcast_period(broadcast_period, *pos, adaptive_broadcast)
+        sleep_unless_stopped(period, stop)
 
 
 def execute(
@@ -285,16 +398,28 @@ def execute(
     speed: float,
     backend_url: str,
     masquerade_as: str = "",
-    silent: bool = False
+    silent: bool = False,
+    repath_period: float = 5.0,
+    target: str = "",
+    shared_path_tree: bool = False,
+    bot_id: str = None,
+    control: BotControl = None,
+    min_leg_distance: float = None,
+    max_leg_distance: float = None,
+    adaptive_broadcast: bool = False,
 ) -> None:
-    with bot_context(profile, masquerade_as, backend_url) as bot_id:
+    stop = control.stop if control is not None else None
+    with bot_context(profile, masquerade_as, backend_url, bot_id=bot_id, control=control) as bot_id:
         if profile == BotProfile.STATIONARY:
             do_stationary_bot(
                 bot_id,
                 latitude,
                 longitude,
                 duration,
-                broadcast_period
+                broadcast_period,
+                region=region,
+                stop=stop,
+                adaptive_broadcast=adaptive_broadcast,
             )
             return
 
@@ -316,6 +441,11 @@ def execute(
                 duration=duration,
                 broadcast_period=broadcast_period,
                 verbose=not silent,
+                region=region,
+                stop=stop,
+                min_leg_distance=min_leg_distance,
+                max_leg_distance=max_leg_distance,
+                adaptive_broadcast=adaptive_broadcast,
             )
         elif profile == BotProfile.RAMBLE_TEAM:
             # check out an additional bot
@@ -325,8 +455,24 @@ def execute(
             # TODO: implement
             pass
         elif profile == BotProfile.HUNT_ROAD:
-            # TODO: implement
-            pass
+            if not target:
+                raise ValueError("Road hunting bots need a target")
+            do_hunt_road_bot(
+                bot_id,
+                map,
+                target,
+                latitude,
+                longitude,
+                speed=speed,
+                duration=duration,
+                broadcast_period=broadcast_period,
+                repath_period=repath_period,
+                shared_path_tree=shared_path_tree,
+                verbose=not silent,
+                region=region,
+                stop=stop,
+                adaptive_broadcast=adaptive_broadcast,
+            )
         else:
             raise ValueError(f"We don't support {profile} (yet)")
 
@@ -334,6 +480,8 @@ def execute(
 def main() -> None:
     parser = get_parser()
     args = parser.parse_args()
+    if args.profile == BotProfile.HUNT_ROAD and not args.target:
+        parser.error("hunt_road bots need a --target")
 
     global BACKEND_URL
     if args.backend_url != BACKEND_URL:
@@ -347,7 +495,13 @@ def main() -> None:
         args.duration,
         args.broadcast_period,
         args.speed,
-        args.backend_url
+        args.backend_url,
+        repath_period=args.repath_period,
+        target=args.target,
+        shared_path_tree=args.shared_path_tree,
+        min_leg_distance=args.min_leg_distance,
+        max_leg_distance=args.max_leg_distance,
+        adaptive_broadcast=args.adaptive_broadcast,
     )
 
 
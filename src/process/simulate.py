@@ -0,0 +1,100 @@
+"""
+Precompute ramble bot trajectories offline.
+
+Ambient bots don't react to players, so there's no reason to simulate them live. This runs
+any number of ramble bots against a virtual clock, as fast as the CPU allows, and writes every
+bot's position at every tick to a trajectory file that src.process.replay streams to MQTT.
+
+With the same seed, map and arguments the output is identical, which makes load tests
+reproducible.
+"""
+import argparse
+import os
+import random
+import time
+
+from src.process.ramble import ramble_positions
+from src.tiled_map import load_map
+from src.util.osm_dir import OSM_DIR
+from src.util.trajectory import TrajectoryWriter
+
+
+TRAJECTORY_DIR = "trajectories"
+
+
+def default_output(region: str, bots: int, seed: int) -> str:
+    return os.path.join(OSM_DIR, region, TRAJECTORY_DIR, f"ramble-{bots}-seed{seed}.traj")
+
+
+def simulate(
+    region: str,
+    bots: int,
+    duration: float,
+    output: str,
+    broadcast_period: float = 3.0,
+    speed: float = 1.5,
+    seed: int = 0,
+    min_leg_distance: float = None,
+    max_leg_distance: float = None,
+) -> None:
+    map = load_map(os.path.join(OSM_DIR, region))
+    walkers = [
+        ramble_positions(
+            map,
+            speed=speed,
+            broadcast_period=broadcast_period,
+            min_leg_distance=min_leg_distance,
+            max_leg_distance=max_leg_distance,
+            rng=random.Random(f"{seed}-{idx}"),
+            verbose=False,
+        )
+        for idx in range(bots)
+    ]
+    ticks = int(duration / broadcast_period)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    start = time.time()
+    with TrajectoryWriter(output, bots, broadcast_period) as writer:
+        for tick in range(ticks):
+            writer.write_tick([next(walker) for walker in walkers])
+            if (tick + 1) % 100 == 0:
+                print(f'Simulated {tick + 1}/{ticks} ticks')
+    elapsed = time.time() - start
+    print(
+        f'Wrote {bots} bots x {ticks} ticks ({ticks * broadcast_period:.0f}s of game time) '
+        f'to {output} in {elapsed:.1f}s'
+    )
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("region", choices=os.listdir(OSM_DIR))
+    parser.add_argument("--bots", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=3600.0, help="seconds of game time to simulate")
+    parser.add_argument("--broadcast-period", type=float, default=3.0)
+    parser.add_argument("--speed", type=float, default=1.5)  # walking speed
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min-leg-distance", type=float)
+    parser.add_argument("--max-leg-distance", type=float)
+    parser.add_argument("--output", help="defaults to the region's trajectories directory")
+    return parser
+
+
+def main() -> None:
+    parser = get_parser()
+    args = parser.parse_args()
+    simulate(
+        args.region,
+        args.bots,
+        args.duration,
+        args.output or default_output(args.region, args.bots, args.seed),
+        broadcast_period=args.broadcast_period,
+        speed=args.speed,
+        seed=args.seed,
+        min_leg_distance=args.min_leg_distance,
+        max_leg_distance=args.max_leg_distance,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Find which region a point is in.
+
+Every region's map buckets its nodes by grid cell once at startup, so requests can be checked
+against the regions that actually have maps loaded, and callers that don't know their region
+can have it picked from their position.
+"""
+import typing as T
+
+from src.generate_routes import Map
+from src.generate_routes import Node
+from src.util.distance import haversine_meters
+
+
+# points further than this from every node of a region aren't in it
+REGION_MARGIN_METERS = 500.0
+
+
+class RegionIndex:
+    """
+    The maps of every region, each with its nodes bucketed by grid cell.
+
+    A point is in a region if one of the region's nodes is within the margin of it, and only
+    the nodes in the cells within the margin get checked. Going by nodes rather than bounding
+    boxes means stray nodes far from the rest of a map can't pull in points kilometres from any
+    road. A point near several regions goes to the one with the closest node.
+
+    There are only ever a handful of regions, so a scan over them is all the index this needs.
+    """
+
+    def __init__(self, maps: T.Dict[str, Map], margin: float = REGION_MARGIN_METERS):
+        self._maps = dict(maps)
+        self._margin = margin
+        for map in self._maps.values():
+            map.build_cell_index()
+
+    @classmethod
+    def from_maps(cls, maps: T.Dict[str, Map], margin: float = REGION_MARGIN_METERS) -> "RegionIndex":
+        return cls(maps, margin=margin)
+
+    def __contains__(self, region: str) -> bool:
+        return region in self._maps
+
+    @property
+    def regions(self) -> T.List[str]:
+        return list(self._maps)
+
+    def snap(self, region: str, latitude: float, longitude: float) -> T.Optional[Node]:
+        """
+        Get the region's closest node to a point, or None if the point isn't in the region.
+        """
+        if region not in self._maps:
+            return None
+        return self._maps[region].get_closest_node_within(latitude, longitude, self._margin)
+
+    def contains(self, region: str, latitude: float, longitude: float) -> bool:
+        """
+        Check whether a point is within the margin of one of a region's nodes.
+        """
+        return self.snap(region, latitude, longitude) is not None
+
+    def find(self, latitude: float, longitude: float) -> T.Tuple[T.Optional[str], T.Optional[Node]]:
+        """
+        Get the region a point is in and its closest node there, or (None, None) if it isn't
+        in any of them.
+        """
+        best_region = None
+        best_node = None
+        best_dist = float('inf')
+        for region in self._maps:
+            node = self.snap(region, latitude, longitude)
+            if node is None:
+                continue
+            dist = haversine_meters(latitude, longitude, node.lat, node.lon)
+            if dist < best_dist:
+                best_region, best_node, best_dist = region, node, dist
+        return best_region, best_node
@@ -1,40 +1,61 @@
 from gevent import monkey
 monkey.patch_all()
 
+import functools
+import json
 import math
 import os
 import random
+import signal
 import subprocess
 import sys
 import threading
+import time
 import typing as T
+import gevent
 from flask import Flask, request, jsonify
 from geopy import distance
 from gevent.pywsgi import WSGIServer
+from collections import defaultdict
 from threading import Timer
 from uuid import uuid4
 from pydantic import BaseModel
 from pydantic import Field
+import redis
+from src.coordination import Coordinator
+from src.coordination import LocalStore
+from src.generate_routes import Node
 from src.process.run_bot import BACKEND_URL
+from src.process.run_bot import BotControl
 from src.process.run_bot import BotProfile
+from src.process.run_bot import check_in_bots
+from src.process.run_bot import check_out_bots
 from src.process.run_bot import execute
 from src.process.run_bot import MAP_CACHE
-from src.util.osm_dir import OSM_DIR
-
-if T.TYPE_CHECKING:
-    from uuid import UUID
+from src.process.run_bot import REGION_INDEX
+from src.util.location_cache import get_nearby
+from src.util.simplify import simplify_route
 
 app = Flask(__name__)
 
 # This will hold our subprocesses, using a unique handle for each one.
-subprocesses: T.Dict["UUID", threading.Thread] = {}
+subprocesses: T.Dict[str, threading.Thread] = {}
+bot_controls: T.Dict[str, BotControl] = {}
+
+# how long a bulk stop gets to check bots in and wait for their threads
+STOP_TIMEOUT = 10.0
+
+# Redis URL for sharing bots between instances, or "local" to coordinate in process.
+# Bots run only on the instance that took the request if this isn't set.
+COORDINATOR_URL = os.environ.get("COORDINATOR_URL")
 
 
 LOCATION_JITTER = (0.0008, 0.0008)
 
 
 class StartBotRequest(BaseModel):
-    region: str
+    # picked from the start position if not given
+    region: T.Optional[str] = None
     bot_type: BotProfile
     latitude: float
     longitude: float
@@ -42,30 +63,37 @@ class StartBotRequest(BaseModel):
     duration: float = Field(default=300.0)
     broadcast_period: float = Field(default=5.0)
     repath_period: float = Field(default=5.0)
+    # device ID of the player that hunting bots should chase
+    target: str = Field(default="")
+    # hunting bots chasing the same target can share one shortest path tree
+    shared_path_tree: bool = Field(default=False)
+    # ramble bots pick destinations roughly this far away by road, in meters
+    min_leg_distance: T.Optional[float] = Field(default=None)
+    max_leg_distance: T.Optional[float] = Field(default=None)
     # if bot profile is single target, masquerade as single user.
     # otherwise, masquerade as team.
     masquerade_as: str = Field(default="")
+    # broadcast less often while no human player is nearby
+    adaptive_broadcast: bool = Field(default=False)
+    # start this many identical bots, checked out from the backend in one batch
+    count: int = Field(default=1, ge=1)
 
 
-@app.route('/start', methods=['POST'])
-def start_subprocess():
-    start_bot_request = StartBotRequest.parse_obj(request.json)
-
-    if start_bot_request.region not in os.listdir(OSM_DIR):
-        return jsonify({'error': f'invalid OSM region {start_bot_request.region}'}), 500
-
-    # Generate a unique handle for this process.
-    handle = uuid4()
-    lat_start = start_bot_request.latitude + random.random() * LOCATION_JITTER[0] * (1 if random.random() > 0.5 else -1)
-    lon_start = start_bot_request.longitude + random.random() * LOCATION_JITTER[1] * (1 if random.random() > 0.5 else -1)
-
-    # Start the subprocess and save it in our dictionary.
-    target = execute
+def start_bot_thread(
+    handle: str,
+    start_bot_request: StartBotRequest,
+    bot_id: str = None,
+    on_exit: T.Callable[[], None] = None,
+) -> threading.Thread:
+    """
+    Run a bot on a daemon thread. The bot is checked out on the thread unless a bot ID is given.
+    """
+    control = BotControl(region=start_bot_request.region)
     args = (
         start_bot_request.region,
         start_bot_request.bot_type,
-        lat_start,
-        lon_start,
+        start_bot_request.latitude,
+        start_bot_request.longitude,
         start_bot_request.duration,
         start_bot_request.broadcast_period,
         start_bot_request.speed,
@@ -73,16 +101,216 @@ def start_subprocess():
         start_bot_request.masquerade_as,
     )
     kwargs = {
-        'silent': True
+        'silent': True,
+        'repath_period': start_bot_request.repath_period,
+        'target': start_bot_request.target,
+        'shared_path_tree': start_bot_request.shared_path_tree,
+        'bot_id': bot_id,
+        'control': control,
+        'min_leg_distance': start_bot_request.min_leg_distance,
+        'max_leg_distance': start_bot_request.max_leg_distance,
+        'adaptive_broadcast': start_bot_request.adaptive_broadcast,
     }
-    thread = threading.Thread(target=target, args=args, kwargs=kwargs)
+
+    def target():
+        try:
+            execute(*args, **kwargs)
+        finally:
+            bot_controls.pop(handle, None)
+            if on_exit is not None:
+                on_exit()
+
+    thread = threading.Thread(target=target)
     thread.daemon = True
+    bot_controls[handle] = control
+    subprocesses[handle] = thread
     thread.start()
+    return thread
+
+
+def stop_bots(region: str = None, timeout: float = STOP_TIMEOUT, check_in: bool = True) -> T.List[str]:
+    """
+    Stop every running bot, or every bot in a region, and check them all in together.
+
+    Removal messages carry many ids at once and check ins run concurrently, so this finishes
+    within the timeout however many bots there are. Bots still checking out when this runs
+    check themselves in as they exit.
+
+    Without `check_in` the bots are stopped but left checked out, for another instance to resume.
+    """
+    deadline = time.time() + timeout
+    handles = [handle for handle, control in list(bot_controls.items()) if region is None or control.region == region]
+    controls = [bot_controls[handle] for handle in handles if handle in bot_controls]
+    bot_ids = []
+    for control in controls:
+        if not check_in:
+            control.checked_in = True
+        elif control.bot_id is not None:
+            control.checked_in = True
+            bot_ids.append(control.bot_id)
+        control.stop.set()
+
+    if check_in:
+        with gevent.Timeout(timeout, False):
+            failed = check_in_bots(bot_ids)
+            if failed:
+                print(f'Failed to check in {len(failed)} bots')
+
+    for handle in handles:
+        thread = subprocesses.get(handle)
+        if thread is not None:
+            thread.join(max(deadline - time.time(), 0.0))
+    print(f'Stopped {len(handles)} bots')
+    return handles
+
+
+def launch_coordinated_bots(records: T.Dict[str, T.Dict]) -> T.Dict[str, T.Tuple[threading.Thread, str]]:
+    """
+    Start bots that the coordinator assigned to this instance.
+
+    Bots that haven't been checked out yet get checked out up front, in one batch per bot type,
+    so the registry knows their IDs if they have to be resumed elsewhere.
+    """
+    bot_requests = {handle: StartBotRequest.parse_obj(record) for handle, record in records.items()}
+    bot_ids = {handle: record.get("bot_id") for handle, record in records.items()}
+
+    batches = defaultdict(list)
+    for handle, bot_request in bot_requests.items():
+        if bot_ids[handle] is None:
+            batches[(bot_request.bot_type, bot_request.masquerade_as)].append(handle)
+    for (bot_type, masquerade_as), handles in batches.items():
+        try:
+            checked_out = check_out_bots(bot_type, masquerade_as, BACKEND_URL, len(handles))
+        except Exception as exc:
+            # the coordinator tries these again next sync
+            print(f'Failed to check out {len(handles)} {bot_type.name} bots: {exc!r}')
+            continue
+        bot_ids.update(zip(handles, checked_out))
+
+    launched = dict()
+    for handle, bot_request in bot_requests.items():
+        if bot_ids[handle] is None:
+            continue
+        thread = start_bot_thread(
+            handle,
+            bot_request,
+            bot_id=bot_ids[handle],
+            on_exit=functools.partial(COORDINATOR.bot_finished, handle),
+        )
+        launched[handle] = (thread, bot_ids[handle])
+    return launched
+
+
+def stop_coordinated_bot(handle: str, check_in: bool) -> None:
+    """
+    Stop a bot the coordinator no longer wants running here. Without `check_in` it stays
+    checked out, so the instance that owns it now can carry on with it.
+    """
+    control = bot_controls.get(handle)
+    if control is not None:
+        if not check_in:
+            control.checked_in = True
+        control.stop.set()
+
+
+def get_coordinator() -> T.Optional[Coordinator]:
+    if not COORDINATOR_URL:
+        return None
+    if COORDINATOR_URL == "local":
+        store = LocalStore()
+    else:
+        store = redis.Redis.from_url(COORDINATOR_URL)
+    return Coordinator(store, launch_coordinated_bots, stop_coordinated_bot)
+
+
+COORDINATOR = get_coordinator()
+
+
+def resolve_region(
+    region: T.Optional[str],
+    latitude: float,
+    longitude: float,
+) -> T.Tuple[T.Optional[str], T.Optional[Node], T.Optional[str]]:
+    """
+    Check a point is inside the requested region, or find its region if none was requested.
+
+    Returns (region, closest node, None) if the point is good, or (None, None, error message)
+    if it isn't.
+    """
+    if region is None:
+        region, node = REGION_INDEX.find(latitude, longitude)
+        if region is None:
+            return None, None, f'({latitude}, {longitude}) is not in any OSM region'
+        return region, node, None
+    if region not in REGION_INDEX:
+        return None, None, f'invalid OSM region {region}'
+    node = REGION_INDEX.snap(region, latitude, longitude)
+    if node is None:
+        return None, None, f'({latitude}, {longitude}) is outside of OSM region {region}'
+    return region, node, None
+
+
+@app.route('/start', methods=['POST'])
+def start_subprocess():
+    start_bot_request = StartBotRequest.parse_obj(request.json)
+    if start_bot_request.bot_type == BotProfile.HUNT_ROAD and not start_bot_request.target:
+        return jsonify({'error': 'road hunting bots need a target'}), 400
+
+    region, _, error = resolve_region(start_bot_request.region, start_bot_request.latitude, start_bot_request.longitude)
+    if error is not None:
+        return jsonify({'error': error}), 400
+    start_bot_request.region = region
+
+    # Generate a unique handle for each bot, each starting from a jittered position.
+    bot_requests = dict()
+    for _ in range(start_bot_request.count):
+        bot_request = start_bot_request.copy()
+        bot_request.latitude += random.random() * LOCATION_JITTER[0] * (1 if random.random() > 0.5 else -1)
+        bot_request.longitude += random.random() * LOCATION_JITTER[1] * (1 if random.random() > 0.5 else -1)
+        bot_requests[str(uuid4())] = bot_request
+    handles = list(bot_requests)
+
+    if COORDINATOR is not None:
+        # whichever instance owns the bot checks it out and starts it, off the request path
+        owners = COORDINATOR.register_bots({
+            handle: json.loads(bot_request.json())
+            for handle, bot_request in bot_requests.items()
+        })
+        return jsonify({'handle': handles[0], 'handles': handles, 'owners': owners}), 200
+
+    # Check everything out in one go rather than one bot at a time.
+    bot_ids = [None] * len(handles)
+    if len(handles) > 1:
+        bot_ids = check_out_bots(
+            start_bot_request.bot_type,
+            start_bot_request.masquerade_as,
+            BACKEND_URL,
+            len(handles),
+        )
+
+    # Start the subprocess and save it in our dictionary.
     # TODO: do we want to log errors?
-    subprocesses[handle] = thread
+    for handle, bot_id in zip(handles, bot_ids):
+        start_bot_thread(handle, bot_requests[handle], bot_id=bot_id)
 
     # Return the handle to the client.
-    return jsonify({'handle': handle}), 200
+    return jsonify({'handle': handles[0], 'handles': handles}), 200
+
+
+class StopAllRequest(BaseModel):
+    # only stop bots in this region if given
+    region: T.Optional[str] = None
+
+
+@app.route('/stop_all', methods=['POST'])
+def api_stop_all():
+    stop_all_request = StopAllRequest.parse_obj(request.get_json(silent=True) or dict())
+    if COORDINATOR is not None:
+        # every instance stops and checks in its own share of the bots
+        handles = COORDINATOR.remove_bots(region=stop_all_request.region)
+        return jsonify({'handles': handles}), 200
+    handles = stop_bots(region=stop_all_request.region)
+    return jsonify({'handles': handles}), 200
 
 
 class GetRouteRequest(BaseModel):
@@ -91,7 +319,13 @@ class GetRouteRequest(BaseModel):
     duration: float = 5 * 60 * 60.0  # five hours of travel in game time, almost certainly won't need this
     latitude: float  # starting latitude
     longitude: float  # starting longitude
-    region: str = "sf_north_beach"
+    # picked from the start position if not given
+    region: T.Optional[str] = None
+    # pick each leg's destination roughly this far away by road, in meters
+    min_leg_distance: T.Optional[float] = None
+    max_leg_distance: T.Optional[float] = None
+    # drop waypoints that are within this many meters of the simplified route, 0 keeps them all
+    simplify_tolerance: float = 0.0
 
 
 class Waypoint(BaseModel):
@@ -102,6 +336,8 @@ class Waypoint(BaseModel):
 
 class GetRouteResponse(BaseModel):
     nodes: T.List[Waypoint]
+    original_count: int  # waypoints before simplification
+    compression_ratio: float  # original_count / len(nodes)
 
 
 @app.route("/get_route", methods=["POST"])
@@ -110,19 +346,26 @@ def api_get_route():
     Return a path with some parameters.
     """
     route_request = GetRouteRequest.parse_obj(request.json)
-    map = MAP_CACHE.get(route_request.region)
-    if map is None:
-        raise ValueError(f"Invalid map {route_request.region}")
+    region, start, error = resolve_region(route_request.region, route_request.latitude, route_request.longitude)
+    if error is not None:
+        return jsonify({'error': error}), 400
+    map = MAP_CACHE[region]
 
     distance_traveled = 0.0
     game_time = 0.0
-    start = map.get_closest_node_to_point(route_request.latitude, route_request.longitude)
     output = []
     output.append(Waypoint(game_time=game_time, latitude=start.latitude, longitude=start.longitude))
     prev_node = start
     while game_time < route_request.duration:
         # find the next node
-        next_node = map.get_random_node()
+        if route_request.min_leg_distance is None and route_request.max_leg_distance is None:
+            next_node = map.get_random_node()
+        else:
+            next_node = map.get_random_node_in_band(
+                prev_node,
+                route_request.min_leg_distance or 0.0,
+                route_request.max_leg_distance or float('inf'),
+            )
         path = map.get_shortest_route_between_points(prev_node, next_node)
         for node1, node2 in zip(path[:-1], path[1:]):
             dist = distance.distance((node1.latitude, node1.longitude), (node2.latitude, node2.longitude)).meters
@@ -130,12 +373,76 @@ def api_get_route():
             time_delta = dist / route_request.speed
             game_time += time_delta
             output.append(Waypoint(game_time=game_time, latitude=node2.latitude, longitude=node2.longitude))
+        if path:
+            prev_node = path[-1]
+
+    # game times were stamped along the full route, so the waypoints we keep stay on schedule
+    # and clients interpolating between them cover the dropped points at the same pace
+    original_count = len(output)
+    kept = simplify_route([(x.latitude, x.longitude) for x in output], route_request.simplify_tolerance)
+    output = [output[idx] for idx in kept]
+
+    return jsonify(GetRouteResponse(
+        nodes=output,
+        original_count=original_count,
+        compression_ratio=original_count / len(output),
+    ).dict()), 200
+
+
+class NearbyRequest(BaseModel):
+    latitude: float
+    longitude: float
+    radius: float = 500.0  # meters
+    limit: T.Optional[int] = None
 
-    return jsonify(GetRouteResponse(nodes=output).dict()), 200
+
+class NearbyEntity(BaseModel):
+    device_id: str
+    latitude: float
+    longitude: float
+    distance: float  # meters
+
+
+class NearbyResponse(BaseModel):
+    entities: T.List[NearbyEntity]
+
+
+@app.route("/nearby", methods=["POST"])
+def api_nearby():
+    """
+    Return the players and bots within a radius of a point, closest first.
+    """
+    nearby_request = NearbyRequest.parse_obj(request.json)
+    entities = [
+        NearbyEntity(device_id=device_id, latitude=lat, longitude=lon, distance=dist)
+        for device_id, lat, lon, dist in get_nearby(
+            nearby_request.latitude,
+            nearby_request.longitude,
+            nearby_request.radius,
+            limit=nearby_request.limit,
+        )
+    ]
+    return jsonify(NearbyResponse(entities=entities).dict()), 200
 
 
 if __name__ == '__main__':
     print("Starting server")
+    if COORDINATOR is not None:
+        print(f"Coordinating bots as {COORDINATOR.instance_id}")
+        COORDINATOR.start()
     server = WSGIServer(('0.0.0.0', 8080), app)
+
+    # stopping the server returns us from serve_forever, and the bots get stopped below
+    gevent.signal_handler(signal.SIGTERM, server.stop, 1.0)
+    gevent.signal_handler(signal.SIGINT, server.stop, 1.0)
     server.serve_forever()
 
+    if COORDINATOR is not None:
+        # leave our bots checked out and in the registry for the other instances to take over
+        print("Shutting down, handing bots over to other instances")
+        COORDINATOR.shutdown()
+        stop_bots(check_in=False)
+    else:
+        print("Shutting down, checking in all bots")
+        stop_bots()
+
@@ -0,0 +1,379 @@
+"""
+Tiled road graphs for regions too big to hold in memory as a single graph.
+
+A tiled region is cut into fixed size lat/lon tiles. Each tile holds the roads inside it, and
+an overlay graph joins the tiles together:
+ * boundary nodes are the ends of any road that crosses from one tile into another
+ * overlay edges are either those crossing roads, or shortcuts between two boundary nodes of
+   the same tile weighted by the shortest path inside that tile
+
+Tiles are only read from disk once something touches them, so memory scales with the parts
+of the city bots are actually in rather than the size of the city.
+"""
+import heapq
+import itertools
+import math
+import os
+import pickle
+import random
+import threading
+import typing as T
+from array import array
+from collections import defaultdict
+from collections import OrderedDict
+
+import networkx as nx
+from networkx.algorithms.shortest_paths.generic import shortest_path
+
+from src.generate_routes import landmark_table
+from src.generate_routes import Map
+from src.generate_routes import Node
+from src.generate_routes import NodeStore
+from src.util.distance import haversine_meters
+from src.util.distance import METERS_PER_DEGREE
+
+
+TILE_DIR = "tiles"
+TILE_INDEX = "index.pickle"
+TILE_OVERLAY = "overlay.gpickle"
+TILE_FORMAT_VERSION = 2
+
+TileKey = T.Tuple[int, int]
+
+
+def tile_key(lat: float, lon: float, tile_size: float) -> TileKey:
+    return math.floor(lat / tile_size), math.floor(lon / tile_size)
+
+
+def tile_filename(key: TileKey) -> str:
+    return f"tile_{key[0]}_{key[1]}.gpickle"
+
+
+def _label_by_ref_id(graph: nx.Graph, store: NodeStore) -> nx.Graph:
+    """
+    Tiles are written keyed by node id with positions as node attributes, since node indices
+    only mean something inside the map that assigned them.
+    """
+    labeled = nx.relabel_nodes(graph, {idx: store.ref_ids[idx] for idx in graph.nodes})
+    for idx in graph.nodes:
+        labeled.nodes[store.ref_ids[idx]].update(lat=store.lats[idx], lon=store.lons[idx])
+    return labeled
+
+
+def write_tiles(map: Map, dirname: str, tile_size: float) -> None:
+    """
+    Cut a map into tiles and write them, the overlay and the tile index to a directory.
+    """
+    graph = map._map
+    store = map._store
+    os.makedirs(dirname, exist_ok=True)
+
+    def key_of(idx: int) -> TileKey:
+        return tile_key(store.lats[idx], store.lons[idx], tile_size)
+
+    tiles: T.DefaultDict[TileKey, T.Set[int]] = defaultdict(set)
+    for node in graph.nodes:
+        tiles[key_of(node)].add(node)
+
+    # roads that cross tiles become overlay edges as they are
+    overlay = nx.Graph()
+    boundary: T.DefaultDict[TileKey, T.Set[int]] = defaultdict(set)
+    for u, v, weight in graph.edges(data='weight'):
+        u_key = key_of(u)
+        v_key = key_of(v)
+        if u_key != v_key:
+            overlay.add_edge(u, v, weight=weight, tile=None)
+            boundary[u_key].add(u)
+            boundary[v_key].add(v)
+
+    landmarks = map._landmarks
+    for key, nodes in tiles.items():
+        tile_graph = nx.Graph(graph.subgraph(nodes))
+        tile_graph.graph.clear()
+        labeled = _label_by_ref_id(tile_graph, store)
+        # each tile only carries the landmark distances for its own nodes
+        if landmarks:
+            labeled.graph['landmarks'] = {
+                store.ref_ids[node]: array('f', (distances[node] for distances in landmarks))
+                for node in nodes
+            }
+        nx.write_gpickle(labeled, os.path.join(dirname, tile_filename(key)))
+
+        # connect every pair of boundary nodes in the tile by their in-tile shortest path
+        for b1 in boundary[key]:
+            lengths = nx.single_source_dijkstra_path_length(tile_graph, b1, weight='weight')
+            for b2 in boundary[key]:
+                if b2 == b1 or b2 not in lengths:
+                    continue
+                if not overlay.has_edge(b1, b2) or overlay[b1][b2]['weight'] > lengths[b2]:
+                    overlay.add_edge(b1, b2, weight=lengths[b2], tile=key)
+
+    nx.write_gpickle(_label_by_ref_id(overlay, store), os.path.join(dirname, TILE_OVERLAY))
+    index = dict(
+        version=TILE_FORMAT_VERSION,
+        tile_size=tile_size,
+        tiles={key: len(nodes) for key, nodes in tiles.items()},
+    )
+    with open(os.path.join(dirname, TILE_INDEX), 'wb') as outfile:
+        pickle.dump(index, outfile)
+    print(f'Wrote {len(tiles)} tiles with {overlay.number_of_nodes()} boundary nodes to {dirname}')
+
+
+class TiledMap(Map):
+    """
+    A Map that pages tiles in and out of its graph as they get used.
+
+    The inherited graph only holds the loaded tiles plus the roads between them. Least recently
+    used tiles are dropped once more than max_loaded_tiles are loaded, and are read back if
+    anything asks for them again. Positions of nodes from evicted tiles stay in the node store,
+    so Nodes that bots hang on to stay valid and get the same index when their tile comes back.
+    """
+
+    def __init__(self, dirname: str, max_loaded_tiles: int = 256):
+        super().__init__()
+        self._dirname = dirname
+        self._max_loaded_tiles = max_loaded_tiles
+        with open(os.path.join(dirname, TILE_INDEX), 'rb') as infile:
+            index = pickle.load(infile)
+        if index["version"] != TILE_FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported tile format {index['version']} in {dirname}, "
+                f"regenerate the tiles with generate_routes --write-tiles"
+            )
+        self._tile_size: float = index["tile_size"]
+        self._tile_keys: T.Set[TileKey] = set(index["tiles"])
+
+        overlay: nx.Graph = nx.read_gpickle(os.path.join(dirname, TILE_OVERLAY))
+        self._overlay = nx.relabel_nodes(overlay, {
+            ref_id: self._store.add(ref_id, data['lat'], data['lon'])
+            for ref_id, data in overlay.nodes(data=True)
+        })
+
+        self._loaded: T.OrderedDict[TileKey, T.List[int]] = OrderedDict()
+        self._tile_lock = threading.RLock()
+
+    @classmethod
+    def read_from_cache(cls, dirname: str) -> "TiledMap":
+        return cls(dirname)
+
+    @property
+    def loaded_tiles(self) -> T.List[TileKey]:
+        return list(self._loaded)
+
+    def _key(self, index: int) -> TileKey:
+        return tile_key(self._store.lats[index], self._store.lons[index], self._tile_size)
+
+    def _load_landmarks(self, rows: T.Dict[str, array]) -> None:
+        if not rows:
+            return
+        if self._landmarks is None:
+            self._landmarks = landmark_table(len(next(iter(rows.values()))), 0)
+        for distances in self._landmarks:
+            distances.extend(array('f', [math.nan]) * (len(self._store) - len(distances)))
+        for ref_id, row in rows.items():
+            idx = self._store.index_of(ref_id)
+            for distances, dist in zip(self._landmarks, row):
+                distances[idx] = dist
+
+    def _load_tile(self, key: TileKey) -> T.List[int]:
+        with self._tile_lock:
+            if key in self._loaded:
+                self._loaded.move_to_end(key)
+                return self._loaded[key]
+            if key not in self._tile_keys:
+                return []
+
+            tile_graph: nx.Graph = nx.read_gpickle(os.path.join(self._dirname, tile_filename(key)))
+            mapping = {
+                ref_id: self._store.add(ref_id, data['lat'], data['lon'])
+                for ref_id, data in tile_graph.nodes(data=True)
+            }
+            nodes = list(mapping.values())
+            self._map.add_nodes_from(nodes)
+            self._map.add_weighted_edges_from(
+                (mapping[u], mapping[v], weight) for u, v, weight in tile_graph.edges(data='weight')
+            )
+            if 'landmarks' in tile_graph.graph:
+                self._load_landmarks(tile_graph.graph['landmarks'])
+            # hook up roads to neighboring tiles that are already loaded
+            for node in nodes:
+                if node not in self._overlay:
+                    continue
+                for neighbor, data in self._overlay[node].items():
+                    if data['tile'] is None and neighbor in self._map:
+                        self._map.add_edge(node, neighbor, weight=data['weight'])
+
+            self._loaded[key] = nodes
+            self._graph_nodes = None
+            while len(self._loaded) > self._max_loaded_tiles:
+                self._evict_tile(next(iter(self._loaded)))
+            return self._loaded[key]
+
+    def _evict_tile(self, key: TileKey) -> None:
+        self._map.remove_nodes_from(self._loaded.pop(key))
+        self._graph_nodes = None
+
+    def _ensure_loaded(self, index: int) -> None:
+        if index not in self._map:
+            self._load_tile(self._key(index))
+
+    def _load_around_point(self, lat: float, lon: float) -> T.List[int]:
+        """
+        Load the tile under a point and the tiles around it, since the closest node to a point
+        near a tile edge can be on the other side.
+        """
+        center = tile_key(lat, lon, self._tile_size)
+        keys = [
+            (center[0] + dx, center[1] + dy)
+            for dx, dy in itertools.product((-1, 0, 1), repeat=2)
+            if (center[0] + dx, center[1] + dy) in self._tile_keys
+        ]
+        if not keys:
+            # off the edge of the region, use whatever tile is closest
+            keys = [min(self._tile_keys, key=lambda k: (k[0] - center[0]) ** 2 + (k[1] - center[1]) ** 2)]
+        nodes = []
+        for key in keys:
+            nodes.extend(self._load_tile(key))
+        return nodes
+
+    def get_node_from_id(self, ref_id: str) -> Node:
+        node = super().get_node_from_id(ref_id)
+        self._ensure_loaded(node.index)
+        return node
+
+    def get_neighbors_of_node(self, ref_id: str):
+        node = self.get_node_from_id(ref_id)
+        list(self.get_weighted_neighbor_indices(node.index))
+        return super().get_neighbors_of_node(ref_id)
+
+    def get_weighted_neighbor_indices(self, index: int) -> T.Iterator[T.Tuple[int, float]]:
+        if index in self._overlay:
+            # stepping across a tile edge pulls in the tile on the other side
+            for neighbor, data in self._overlay[index].items():
+                if data['tile'] is None:
+                    self._ensure_loaded(neighbor)
+        # touch our own tile last so it can't be the one that just got evicted
+        self._load_tile(self._key(index))
+        yield from list(super().get_weighted_neighbor_indices(index))
+
+    def get_closest_node_to_point(self, lat: float, lon: float) -> Node:
+        lats, lons = self._store.lats, self._store.lons
+        scale = math.cos(math.radians(lat))
+        return Node(self._store, min(
+            self._load_around_point(lat, lon),
+            key=lambda idx: (lats[idx] - lat) ** 2 + ((lons[idx] - lon) * scale) ** 2,
+        ))
+
+    def build_cell_index(self) -> None:
+        # the tile index already says where the nodes are
+        pass
+
+    def get_closest_node_within(self, lat: float, lon: float, max_dist: float) -> T.Optional[Node]:
+        """
+        Only the tiles within reach of the point get loaded, and none if there aren't any.
+        """
+        lat_margin = max_dist / METERS_PER_DEGREE
+        lon_margin = lat_margin / max(math.cos(math.radians(lat)), 1e-6)
+        min_key = tile_key(lat - lat_margin, lon - lon_margin, self._tile_size)
+        max_key = tile_key(lat + lat_margin, lon + lon_margin, self._tile_size)
+        keys = [
+            key for key in itertools.product(range(min_key[0], max_key[0] + 1), range(min_key[1], max_key[1] + 1))
+            if key in self._tile_keys
+        ]
+        lats, lons = self._store.lats, self._store.lons
+        best = None
+        best_dist = max_dist
+        for key in keys:
+            for idx in self._load_tile(key):
+                dist = haversine_meters(lat, lon, lats[idx], lons[idx])
+                if dist <= best_dist:
+                    best, best_dist = idx, dist
+        return None if best is None else Node(self._store, best)
+
+    def get_random_node(self, rng: random.Random = None) -> Node:
+        """
+        Pick a random node out of the tiles that are loaded right now.
+        """
+        rng = rng or random
+        if not self._loaded:
+            self._load_tile(rng.choice(sorted(self._tile_keys)))
+        return Node(self._store, rng.choice(self._loaded[rng.choice(list(self._loaded))]))
+
+    def get_shortest_route_between_points(self, start_node: Node, end_node: Node) -> T.List[Node]:
+        """
+        Route through the overlay, then expand the in-tile shortcuts that the route used.
+
+        Only the start tile, the end tile and tiles the route passes through get loaded.
+        """
+        start, end = start_node.index, end_node.index
+        self._ensure_loaded(start)
+        self._ensure_loaded(end)
+        local_keys = {self._key(start), self._key(end)}
+
+        def edges(node: int) -> T.Iterator[T.Tuple[int, float, T.Optional[TileKey]]]:
+            if node in self._overlay:
+                for neighbor, data in self._overlay[node].items():
+                    yield neighbor, data['weight'], data['tile']
+            node_key = self._key(node)
+            if node_key in local_keys:
+                self._ensure_loaded(node)
+                for neighbor, weight in super(TiledMap, self).get_weighted_neighbor_indices(node):
+                    if self._key(neighbor) == node_key:
+                        yield neighbor, weight, None
+
+        counter = itertools.count()
+        dist: T.Dict[int, float] = {start: 0.0}
+        prev: T.Dict[int, T.Tuple[T.Optional[int], T.Optional[TileKey]]] = {start: (None, None)}
+        done: T.Set[int] = set()
+        heap = [(0.0, next(counter), start)]
+        while heap:
+            d, _, node = heapq.heappop(heap)
+            if node in done:
+                continue
+            done.add(node)
+            if node == end:
+                break
+            for neighbor, weight, via_tile in edges(node):
+                if d + weight < dist.get(neighbor, float('inf')):
+                    dist[neighbor] = d + weight
+                    prev[neighbor] = (node, via_tile)
+                    heapq.heappush(heap, (d + weight, next(counter), neighbor))
+
+        if end not in done:
+            return []
+
+        hops = []
+        node = end
+        while node is not None:
+            hops.append((node, prev[node][1]))
+            node = prev[node][0]
+        hops.reverse()
+
+        path = [hops[0][0]]
+        for node, via_tile in hops[1:]:
+            if via_tile is None:
+                path.append(node)
+                continue
+            # swap the shortcut back out for the roads inside its tile
+            tile_nodes = self._load_tile(via_tile)
+            segment = shortest_path(self._map.subgraph(tile_nodes), path[-1], node, 'weight')
+            path.extend(segment[1:])
+        return [Node(self._store, idx) for idx in path]
+
+    def get_shortest_path_tree(self, target: Node, max_age: float):
+        """
+        Path trees only cover the tiles that are loaded, seekers far outside that area should
+        route on their own.
+        """
+        self._ensure_loaded(target.index)
+        return super().get_shortest_path_tree(target, max_age)
+
+
+def load_map(region_dir: str) -> Map:
+    """
+    Load the map for a region, preferring the tiled format if the region has been tiled.
+    """
+    tile_dir = os.path.join(region_dir, TILE_DIR)
+    if os.path.exists(os.path.join(tile_dir, TILE_INDEX)):
+        return TiledMap.read_from_cache(tile_dir)
+    return Map.read_from_cache(os.path.join(region_dir, "map.gpickle"))
@@ -0,0 +1,99 @@
+"""
+Client for the game backend's bot endpoints.
+
+One pooled session is shared per backend URL so bots reuse keep-alive connections instead of
+paying for a new TLS handshake on every check out and check in.
+"""
+import json
+import typing as T
+
+import gevent.pool
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (3.05, 10.0)
+DEFAULT_POOL_SIZE = 64
+
+
+class BackendClient:
+
+    def __init__(
+        self,
+        backend_url: str,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        timeout: T.Tuple[float, float] = DEFAULT_TIMEOUT,
+        connect_retries: int = 2,
+    ):
+        self._backend_url = backend_url
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._session = requests.Session()
+        # only retry failed connects, check outs aren't idempotent
+        retry = Retry(total=connect_retries, connect=connect_retries, read=0, status=0, backoff_factor=0.2)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def _post(self, path: str, body: T.Dict) -> requests.Response:
+        resp = self._session.post(f"{self._backend_url}{path}", json=body, timeout=self._timeout)
+        resp.raise_for_status()
+        return resp
+
+    def check_out(self, bot_type: str, masquerade_as: str) -> str:
+        """
+        Check out a bot. Returns the bot ID, throws if the backend says no.
+        """
+        resp = self._post("/api/bots/check_out", {'bot_type': bot_type, 'masquerade_as': masquerade_as})
+        return json.loads(resp.text)["bot_id"]
+
+    def check_in(self, bot_id: str) -> None:
+        self._post("/api/bots/check_in", {'bot_id': bot_id})
+
+    def check_out_many(self, bot_type: str, masquerade_as: str, count: int) -> T.List[str]:
+        """
+        Check out several bots at once over the pooled connections.
+
+        If any check out fails, the ones that succeeded are checked back in before raising.
+        """
+        results = gevent.pool.Pool(self._pool_size).map(
+            lambda _: self._try(self.check_out, bot_type, masquerade_as),
+            range(count),
+        )
+        bot_ids = [x for x in results if not isinstance(x, Exception)]
+        errors = [x for x in results if isinstance(x, Exception)]
+        if errors:
+            self.check_in_many(bot_ids)
+            raise errors[0]
+        return bot_ids
+
+    def check_in_many(self, bot_ids: T.Iterable[str]) -> T.List[str]:
+        """
+        Check in several bots at once. This is best effort, returns the IDs that failed.
+        """
+        bot_ids = list(bot_ids)
+        results = gevent.pool.Pool(self._pool_size).map(lambda x: self._try(self.check_in, x), bot_ids)
+        failed = []
+        for bot_id, result in zip(bot_ids, results):
+            if isinstance(result, Exception):
+                print(f'Failed to check in {bot_id}: {result!r}')
+                failed.append(bot_id)
+        return failed
+
+    @staticmethod
+    def _try(fn: T.Callable, *args) -> T.Any:
+        try:
+            return fn(*args)
+        except Exception as exc:
+            return exc
+
+
+_CLIENTS: T.Dict[str, BackendClient] = dict()
+
+
+def get_backend_client(backend_url: str) -> BackendClient:
+    if backend_url not in _CLIENTS:
+        _CLIENTS[backend_url] = BackendClient(backend_url)
+    return _CLIENTS[backend_url]
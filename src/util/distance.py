@@ -4,6 +4,7 @@ from geopy import distance
 
 
 EARTH_RADIUS_METERS = 6371E3
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_METERS / 180.0
 
 
 def dist_range(lat0: float, lon0: float, lat1: float, lon1: float) -> float:
@@ -14,6 +15,17 @@ def meters_between_points(lat0: float, lon0: float, lat1: float, lon1: float) ->
     return distance.distance((lat0, lon0), (lat1, lon1)).meters
 
 
+def haversine_meters(lat0: float, lon0: float, lat1: float, lon1: float) -> float:
+    """
+    Great circle distance. Much cheaper than the geodesic and within about 0.5% of it, which is
+    plenty for estimates.
+    """
+    phi0 = math.radians(lat0)
+    phi1 = math.radians(lat1)
+    a = math.sin((phi1 - phi0) / 2) ** 2 + math.cos(phi0) * math.cos(phi1) * math.sin(math.radians(lon1 - lon0) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(min(a, 1.0)))
+
+
 def get_delta_between_points(dist: float, lat0: float, lon0: float, lat1: float, lon1: float) -> T.Tuple[float, float]:
     """
     Go a distance between start (lat0, lon0) and end (lat1, lon1). The magnitude must match.
@@ -0,0 +1,55 @@
+"""
+Minimal geohash encoding, used to name spatial cells.
+"""
+import typing as T
+
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def encode(latitude: float, longitude: float, precision: int = 6) -> str:
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True  # geohash interleaves bits starting with longitude
+    while len(chars) < precision:
+        rng, value = (lon_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            rng[0] = mid
+        else:
+            bits <<= 1
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def cell_size(precision: int) -> T.Tuple[float, float]:
+    """
+    Get the (latitude, longitude) size in degrees of a cell at some precision.
+    """
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def neighborhood(latitude: float, longitude: float, precision: int = 6) -> T.List[str]:
+    """
+    Get the cell containing a point and the eight cells around it.
+    """
+    dlat, dlon = cell_size(precision)
+    cells = []
+    for i in (-1, 0, 1):
+        for j in (-1, 0, 1):
+            cell = encode(latitude + i * dlat, longitude + j * dlon, precision)
+            if cell not in cells:
+                cells.append(cell)
+    return cells
@@ -0,0 +1,130 @@
+"""
+Read and write entity positions in the Redis location cache that forward_mqtt_to_redis populates.
+
+Each entity is stored as JSON under its device ID. Positions are also kept in a Redis GEO set
+so proximity queries don't have to scan every key. GEO members can't expire on their own, so a
+sorted set of last-seen times is used to prune them on the same TTL as the entity keys.
+Human players also go in a GEO set of their own, so bots can look them all up without
+wading through every other bot.
+"""
+import json
+import os
+import time
+import typing as T
+
+import redis
+
+from src.util.location_codec import BOT_DEVICE_PREFIX
+
+
+REDIS_ADDRESS = os.environ.get("REDIS_ADDRESS", "54.176.196.120")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+REDIS_AUTH = os.environ.get("REDIS_AUTH")
+
+LOCATION_TTL = 300  # seconds
+GEO_KEY = "location-geo"
+GEO_SEEN_KEY = "location-geo-seen"
+PLAYER_GEO_KEY = "location-geo-players"
+
+_CLIENT: T.Optional[redis.Redis] = None
+
+
+def get_client() -> redis.Redis:
+    """
+    Lazily create the shared Redis client. redis-py pools connections internally so one
+    client is safe to share across bot threads.
+    """
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = redis.Redis(host=REDIS_ADDRESS, port=REDIS_PORT, db=0, password=REDIS_AUTH)
+    return _CLIENT
+
+
+def get_entity(device_id: str, client: redis.Redis = None) -> T.Optional[T.Dict]:
+    raw = (client or get_client()).get(device_id)
+    if raw is None:
+        return None
+    return json.loads(raw)
+
+
+def get_position(device_id: str, client: redis.Redis = None) -> T.Optional[T.Tuple[float, float]]:
+    """
+    Get the last reported (latitude, longitude) of an entity, or None if it has expired.
+    """
+    entity = get_entity(device_id, client=client)
+    if entity is None:
+        return None
+    return entity["pos_lat"], entity["pos_lon"]
+
+
+def store_entity(entity: T.Dict, client: redis.Redis = None, ttl: int = LOCATION_TTL) -> None:
+    """
+    Cache an entity and index its position, in a single round trip.
+    """
+    device_id = entity["device_id"]
+    pipe = (client or get_client()).pipeline(transaction=False)
+    pipe.set(device_id, json.dumps(entity), ex=ttl)
+    pipe.geoadd(GEO_KEY, (entity["pos_lon"], entity["pos_lat"], device_id))
+    if not device_id.startswith(BOT_DEVICE_PREFIX):
+        pipe.geoadd(PLAYER_GEO_KEY, (entity["pos_lon"], entity["pos_lat"], device_id))
+    pipe.zadd(GEO_SEEN_KEY, {device_id: time.time()})
+    pipe.execute()
+
+
+def expire_positions(client: redis.Redis = None, ttl: int = LOCATION_TTL) -> int:
+    """
+    Drop positions that haven't been updated within the TTL. Returns how many were dropped.
+    """
+    client = client or get_client()
+    stale = client.zrangebyscore(GEO_SEEN_KEY, 0, time.time() - ttl)
+    if stale:
+        pipe = client.pipeline(transaction=False)
+        pipe.zrem(GEO_KEY, *stale)
+        pipe.zrem(PLAYER_GEO_KEY, *stale)
+        pipe.zrem(GEO_SEEN_KEY, *stale)
+        pipe.execute()
+    return len(stale)
+
+
+def get_nearby(
+    latitude: float,
+    longitude: float,
+    radius: float,
+    limit: int = None,
+    client: redis.Redis = None,
+) -> T.List[T.Tuple[str, float, float, float]]:
+    """
+    Find entities within a radius in meters of a point, closest first.
+
+    Returns a list of (device_id, latitude, longitude, distance in meters).
+    """
+    results = (client or get_client()).geosearch(
+        GEO_KEY,
+        longitude=longitude,
+        latitude=latitude,
+        radius=radius,
+        unit="m",
+        sort="ASC",
+        count=limit,
+        withdist=True,
+        withcoord=True,
+    )
+    return [
+        (device_id.decode('utf-8') if isinstance(device_id, bytes) else device_id, lat, lon, dist)
+        for device_id, dist, (lon, lat) in results
+    ]
+
+
+def get_player_positions(client: redis.Redis = None) -> T.List[T.Tuple[str, float, float]]:
+    """
+    Get the (device_id, latitude, longitude) of every human player, in two round trips.
+    """
+    client = client or get_client()
+    players = client.zrange(PLAYER_GEO_KEY, 0, -1)
+    if not players:
+        return []
+    return [
+        (device_id.decode('utf-8') if isinstance(device_id, bytes) else device_id, position[1], position[0])
+        for device_id, position in zip(players, client.geopos(PLAYER_GEO_KEY, *players))
+        if position is not None
+    ]
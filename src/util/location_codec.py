@@ -0,0 +1,179 @@
+"""
+Wire encodings for location update messages.
+
+The legacy encoding is JSON on `gamestate-Location-Update`. The compact encoding is a fixed
+struct layout published on its own topic, so the topic a message arrives on decides how it gets
+decoded. Producers pick an encoding with LOCATION_ENCODING and subscribers can listen to both
+while clients migrate.
+
+With LOCATION_TOPIC_PARTITION set, updates are published under
+`<topic>/<region>/<geohash cell>` instead, so subscribers can wildcard subscribe to just the
+cells around them rather than receiving every update in every region.
+"""
+import json
+import os
+import struct
+import time
+import typing as T
+
+from src.util import geohash
+
+
+LOCATION_UPDATE_TOPIC = "gamestate-Location-Update"
+LOCATION_REMOVE_TOPIC = "gamestate-Location-Remove"
+
+ENCODING_JSON = "json"
+ENCODING_COMPACT_V1 = "v1"
+
+TOPICS_BY_ENCODING = {
+    ENCODING_JSON: LOCATION_UPDATE_TOPIC,
+    ENCODING_COMPACT_V1: f"{LOCATION_UPDATE_TOPIC}-v1",
+}
+ENCODINGS_BY_TOPIC = {topic: encoding for encoding, topic in TOPICS_BY_ENCODING.items()}
+
+LOCATION_ENCODING = os.environ.get("LOCATION_ENCODING", ENCODING_JSON)
+if LOCATION_ENCODING not in TOPICS_BY_ENCODING:
+    raise ValueError(f"Unknown location encoding {LOCATION_ENCODING}")
+
+# publish updates to per-region, per-cell subtopics. Precision 6 cells are about 1.2km x 0.6km
+LOCATION_TOPIC_PARTITION = bool(os.environ.get("LOCATION_TOPIC_PARTITION"))
+LOCATION_TOPIC_PRECISION = int(os.environ.get("LOCATION_TOPIC_PRECISION", 6))
+
+# coordinates are quantized to 1e-7 degrees, which is about a centimeter
+COORDINATE_SCALE = 1e7
+
+# version, timestamp in ms, latitude, longitude, id length -- followed by the utf-8 id
+COMPACT_V1_HEADER = struct.Struct("!BQiiB")
+COMPACT_V1_VERSION = 1
+
+# bots always report with this device prefix, so the compact encoding only carries the uuid
+BOT_DEVICE_PREFIX = "BOT-"
+
+
+def fmt_location_message(client_id: str, latitude: float, longitude: float) -> T.Dict:
+    return dict(
+        transactionId=-1,
+        entity=dict(
+            uuid=client_id,
+            device_id=f"{BOT_DEVICE_PREFIX}{client_id}",
+            timestamp=time.time(),
+            pos_lat=latitude,
+            pos_lon=longitude,
+        )
+    )
+
+
+def location_topic(
+    encoding: str = LOCATION_ENCODING,
+    region: str = None,
+    latitude: float = None,
+    longitude: float = None,
+) -> str:
+    """
+    Get the topic to publish a location update to. Updates are only partitioned if that's
+    turned on and the region and position are known.
+    """
+    topic = TOPICS_BY_ENCODING[encoding]
+    if not LOCATION_TOPIC_PARTITION or region is None or latitude is None or longitude is None:
+        return topic
+    return f"{topic}/{region}/{geohash.encode(latitude, longitude, LOCATION_TOPIC_PRECISION)}"
+
+
+def subscription_filters(encoding: str = LOCATION_ENCODING) -> T.List[str]:
+    """
+    Topic filters that match every location update in an encoding, partitioned or not.
+
+    `topic/#` matches `topic` itself too, so subscribing to both would deliver flat topic
+    updates twice.
+    """
+    topic = TOPICS_BY_ENCODING[encoding]
+    return [f"{topic}/#"]
+
+
+def nearby_topic_filters(
+    region: str,
+    latitude: float,
+    longitude: float,
+    encoding: str = LOCATION_ENCODING,
+) -> T.List[str]:
+    """
+    Topics covering the cell a point is in and the cells around it.
+    """
+    topic = TOPICS_BY_ENCODING[encoding]
+    return [
+        f"{topic}/{region}/{cell}"
+        for cell in geohash.neighborhood(latitude, longitude, LOCATION_TOPIC_PRECISION)
+    ]
+
+
+def encoding_for_topic(topic: str) -> T.Optional[str]:
+    """
+    Get the encoding used on a topic, or None if it isn't a location update topic.
+    """
+    return ENCODINGS_BY_TOPIC.get(topic.split('/', 1)[0])
+
+
+def encode_location(
+    client_id: str,
+    latitude: float,
+    longitude: float,
+    encoding: str = LOCATION_ENCODING,
+    timestamp: float = None,
+) -> T.Union[str, bytes]:
+    if encoding == ENCODING_JSON:
+        msg = fmt_location_message(client_id, latitude, longitude)
+        if timestamp is not None:
+            msg['entity']['timestamp'] = timestamp
+        return json.dumps(msg)
+
+    if encoding == ENCODING_COMPACT_V1:
+        raw_id = client_id.encode('utf-8')
+        if len(raw_id) > 255:
+            raise ValueError(f"Client id too long for compact encoding: {client_id}")
+        return COMPACT_V1_HEADER.pack(
+            COMPACT_V1_VERSION,
+            int((time.time() if timestamp is None else timestamp) * 1000),
+            round(latitude * COORDINATE_SCALE),
+            round(longitude * COORDINATE_SCALE),
+            len(raw_id),
+        ) + raw_id
+
+    raise ValueError(f"Unknown location encoding {encoding}")
+
+
+def decode_location(topic: str, payload: T.Union[str, bytes]) -> T.Dict:
+    """
+    Decode a location update into the entity dict that gets stored in the location cache.
+
+    Raises ValueError for packets that can't be decoded.
+    """
+    encoding = encoding_for_topic(topic)
+    if encoding == ENCODING_JSON:
+        entity = json.loads(payload).get('entity')
+        if entity is None:
+            raise ValueError("Malformed packet - no entity")
+        if entity.get("uuid") is None:
+            raise ValueError("Malformed packet - no uuid")
+        if entity.get("device_id") is None:
+            raise ValueError("Malformed entity - no device ID")
+        return entity
+
+    if encoding == ENCODING_COMPACT_V1:
+        if len(payload) < COMPACT_V1_HEADER.size:
+            raise ValueError("Malformed packet - truncated header")
+        version, timestamp_ms, lat, lon, id_len = COMPACT_V1_HEADER.unpack_from(payload)
+        if version != COMPACT_V1_VERSION:
+            raise ValueError(f"Malformed packet - unsupported version {version}")
+        raw_id = payload[COMPACT_V1_HEADER.size:COMPACT_V1_HEADER.size + id_len]
+        if len(raw_id) != id_len:
+            raise ValueError("Malformed packet - truncated id")
+        uuid = raw_id.decode('utf-8')
+        return dict(
+            uuid=uuid,
+            device_id=f"{BOT_DEVICE_PREFIX}{uuid}",
+            timestamp=timestamp_ms / 1000.0,
+            pos_lat=lat / COORDINATE_SCALE,
+            pos_lon=lon / COORDINATE_SCALE,
+        )
+
+    raise ValueError(f"Not a location update topic: {topic}")
@@ -1,26 +1,221 @@
-"""COPY PASTA MQTT"""
+"""
+MQTT publishing for bots.
+
+Publishes go through a pool of broker connections instead of a single client, so a process
+running lots of bots isn't bottlenecked on one socket and one network loop. Bots are sharded
+across the connections by a key (the bot ID), which keeps each bot's updates in order.
+
+Nothing connects at import. The pool is created on first publish from the MQTT_* environment
+variables. Each connection reconnects on its own network thread, and a health check replaces
+connections that stay down, so publishers never wait on a reconnect. While a bot's connection is
+down its updates go out on another connection that is up.
+"""
 import gevent
 from gevent import monkey
 monkey.patch_all()
 
+import os
 import random
 import threading
+import time
+import typing as T
+import zlib
 from paho.mqtt import client as mqtt_client
-from paho.mqtt.client import _socketpair_compat
 
 
-def init_client(broker="13.56.212.128", port=1883) -> mqtt_client.Client:
+MQTT_BROKER = os.environ.get("MQTT_BROKER", "13.56.212.128")
+MQTT_PORT = int(os.environ.get("MQTT_PORT", 1883))
+MQTT_USER = os.environ.get("MQTT_USER", "mqtt-user")
+MQTT_PASSWORD = os.environ.get("MQTT_PASSWORD", "mqtt-password")
+# number of broker connections bots are sharded across
+MQTT_POOL_SIZE = int(os.environ.get("MQTT_POOL_SIZE", 4))
+# how often connections are checked, and how long one can stay down before it gets replaced
+MQTT_HEALTH_CHECK_PERIOD = float(os.environ.get("MQTT_HEALTH_CHECK_PERIOD", 5.0))
+MQTT_RECONNECT_TIMEOUT = float(os.environ.get("MQTT_RECONNECT_TIMEOUT", 30.0))
+
+
+def init_client(
+    broker: str = MQTT_BROKER,
+    port: int = MQTT_PORT,
+    client_id: str = None,
+    on_connect: T.Callable = None,
+    on_disconnect: T.Callable = None,
+) -> mqtt_client.Client:
+    """
+    Start a client connecting in the background. The network loop retries on its own until the
+    broker answers and reconnects whenever the connection drops.
+    """
     client = mqtt_client.Client(
-        client_id=f"mqtt-publish-task-claims-{random.randint(1000, 10000)}"
+        client_id=client_id or f"mqtt-publish-task-claims-{random.randint(1000, 10000)}"
     )
-    client.username_pw_set("mqtt-user", "mqtt-password")
-    client.connect(broker, port)
+    client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.connect_async(broker, port)
     client.loop_start()
-    print(f'MQTT client connected at {broker}:{port}')
     return client
 
 
-CLIENT = init_client()
+class PooledConnection:
+    """
+    One broker connection in the pool.
+    """
+
+    def __init__(self, name: str, broker: str, port: int):
+        self.name = name
+        self._broker = broker
+        self._port = port
+        self._lock = threading.Lock()
+        self.connected = False
+        self.last_connected = time.time()
+        self.published = 0
+        self.failed = 0
+        self._client: T.Optional[mqtt_client.Client] = None
+        self._client = self._start()
+
+    def _start(self) -> mqtt_client.Client:
+        client_id = f"mqtt-publish-task-claims-{random.randint(1000, 10000)}-{self.name}"
+        return init_client(
+            self._broker,
+            self._port,
+            client_id=client_id,
+            on_connect=self._on_connect,
+            on_disconnect=self._on_disconnect,
+        )
+
+    def _on_connect(self, client, userdata, flags, rc) -> None:
+        if rc == 0:
+            self.connected = True
+            self.last_connected = time.time()
+            print(f'MQTT connection {self.name} connected at {self._broker}:{self._port}')
+
+    def _on_disconnect(self, client, userdata, rc) -> None:
+        # ignore the client this replaced going away
+        if client is self._client:
+            self.connected = False
+            print(f'MQTT connection {self.name} disconnected ({rc})')
+
+    def publish(self, topic: str, payload: T.Union[str, bytes], qos: int = 0, retain: bool = False) -> bool:
+        info = self._client.publish(topic, payload, qos=qos, retain=retain)
+        if info.rc == mqtt_client.MQTT_ERR_SUCCESS:
+            self.published += 1
+            return True
+        self.failed += 1
+        return False
+
+    def check(self) -> None:
+        """
+        Replace the client if it's been down too long for its own reconnects to be trusted.
+
+        The new client connects in the background. Publishers keep using the old one (or
+        other connections) until it is swapped in.
+        """
+        if self.connected:
+            self.last_connected = time.time()
+            return
+        if time.time() - self.last_connected < MQTT_RECONNECT_TIMEOUT:
+            return
+        with self._lock:
+            print(f'MQTT connection {self.name} down for {MQTT_RECONNECT_TIMEOUT}s, replacing it')
+            old = self._client
+            self.last_connected = time.time()
+            self._client = self._start()
+        old.loop_stop()
+        old.disconnect()
+
+    def close(self) -> None:
+        self._client.loop_stop()
+        self._client.disconnect()
+
+
+class MQTTPool:
+    """
+    A fixed number of broker connections with publishers sharded across them by key.
+    """
+
+    def __init__(
+        self,
+        size: int = MQTT_POOL_SIZE,
+        broker: str = MQTT_BROKER,
+        port: int = MQTT_PORT,
+        health_check_period: float = MQTT_HEALTH_CHECK_PERIOD,
+    ):
+        self._connections = [PooledConnection(str(idx), broker, port) for idx in range(max(size, 1))]
+        self._stop = threading.Event()
+        self._health_check_period = health_check_period
+        health_check = threading.Thread(target=self._health_check_forever)
+        health_check.daemon = True
+        health_check.start()
+
+    @property
+    def connections(self) -> T.List[PooledConnection]:
+        return list(self._connections)
+
+    def _shard(self, key: str) -> int:
+        return zlib.crc32(key.encode('utf-8')) % len(self._connections)
+
+    def publish(
+        self,
+        topic: str,
+        payload: T.Union[str, bytes],
+        key: str = None,
+        qos: int = 0,
+        retain: bool = False,
+    ) -> bool:
+        """
+        Publish on the connection a key is sharded to, or the next one up if that one's down.
+
+        Returns False if no connection would take the message.
+        """
+        shard = self._shard(key if key is not None else topic)
+        count = len(self._connections)
+        for offset in range(count):
+            connection = self._connections[(shard + offset) % count]
+            if not connection.connected and offset < count - 1:
+                continue
+            if connection.publish(topic, payload, qos=qos, retain=retain):
+                return True
+        return False
+
+    def _health_check_forever(self) -> None:
+        while not self._stop.wait(self._health_check_period):
+            for connection in self._connections:
+                try:
+                    connection.check()
+                except Exception as exc:
+                    print(f'MQTT health check on {connection.name} failed: {exc!r}')
+
+    def close(self) -> None:
+        self._stop.set()
+        for connection in self._connections:
+            connection.close()
+
+
+_POOL: T.Optional[MQTTPool] = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool() -> MQTTPool:
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = MQTTPool()
+    return _POOL
+
+
+def publish(
+    topic: str,
+    payload: T.Union[str, bytes],
+    key: str = None,
+    qos: int = 0,
+    retain: bool = False,
+) -> bool:
+    """
+    Publish through the shared pool. Pass the bot ID as the key to keep a bot's updates in order.
+    """
+    return get_pool().publish(topic, payload, key=key, qos=qos, retain=retain)
 
 
 def publish_with_retries(
@@ -30,34 +225,15 @@ def publish_with_retries(
     retain: bool = True,
     qos: int = 0,
     retries: int = 0,
-    broker: str = None,
-    port: int = None
+    key: str = None,
 ) -> bool:
-    global CLIENT
-
     total_publish = 0
-    if retries < 0:
-        return False
-    try:
-        kwargs = dict()
-        if broker is not None:
-            kwargs['broker'] = broker
-        if port is not None:
-            kwargs['port'] = port
-        while total_publish < publishes:
-            #client.publish(topic, payload, qos=qos, retain=retain)
-            CLIENT.publish(topic, payload, qos=qos, retain=retain)
+    while total_publish < publishes:
+        if publish(topic, payload, key=key, qos=qos, retain=retain):
             total_publish += 1
-        return True
-    except Exception as exc:
-        print(repr(exc))
-        CLIENT = init_client()
-        publish_with_retries(
-            topic,
-            payload,
-            retain=retain,
-            qos=qos,
-            retries=retries - 1,
-            broker=broker,
-            port=port
-        )
+            continue
+        if retries <= 0:
+            return False
+        retries -= 1
+        gevent.sleep(0.1)
+    return True
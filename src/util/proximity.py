@@ -0,0 +1,131 @@
+"""
+Slow bots down when no human player is around to see them.
+
+A single monitor per process pulls every player position out of the location cache every few
+seconds and buckets them by geohash cell. Bots ask it for their broadcast period each tick,
+which is a lookup in the cells around them rather than a Redis call.
+"""
+import math
+import os
+import threading
+import typing as T
+from collections import defaultdict
+
+from src.util import geohash
+from src.util.distance import haversine_meters
+from src.util.location_cache import get_player_positions
+
+
+# bots within this many meters of a player broadcast at their full rate
+PROXIMITY_NEAR_METERS = float(os.environ.get("PROXIMITY_NEAR_METERS", 500.0))
+# bots further than this from every player broadcast at the slowest rate
+PROXIMITY_FAR_METERS = float(os.environ.get("PROXIMITY_FAR_METERS", 2000.0))
+# how many times slower than its full rate a bot far from everyone broadcasts
+PROXIMITY_MAX_BACKOFF = float(os.environ.get("PROXIMITY_MAX_BACKOFF", 6.0))
+# how often player positions are pulled from the location cache
+PROXIMITY_REFRESH_PERIOD = float(os.environ.get("PROXIMITY_REFRESH_PERIOD", 5.0))
+
+# precision 5 cells are about 4.9km x 4.9km, so a cell and its neighbors cover the far radius
+PROXIMITY_PRECISION = 5
+
+
+class ProximityMonitor:
+    """
+    Keeps a snapshot of where players are and turns distance to the closest one into a
+    broadcast period.
+
+    Until the first snapshot comes in, or if the location cache can't be reached, every bot
+    broadcasts at its full rate.
+    """
+
+    def __init__(
+        self,
+        near: float = PROXIMITY_NEAR_METERS,
+        far: float = PROXIMITY_FAR_METERS,
+        max_backoff: float = PROXIMITY_MAX_BACKOFF,
+        refresh_period: float = PROXIMITY_REFRESH_PERIOD,
+    ):
+        self._near = near
+        self._far = max(far, near)
+        self._max_backoff = max(max_backoff, 1.0)
+        self._refresh_period = refresh_period
+        self._cells: T.Optional[T.Dict[str, T.List[T.Tuple[float, float]]]] = None
+        self._thread: T.Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def refresh(self) -> None:
+        """
+        Replace the snapshot with the current player positions. Drops back to full rate for
+        everything if the location cache can't be read.
+        """
+        try:
+            players = get_player_positions()
+        except Exception as exc:
+            print(f'Failed to read player positions: {exc!r}')
+            self._cells = None
+            return
+        cells: T.DefaultDict[str, T.List[T.Tuple[float, float]]] = defaultdict(list)
+        for _, lat, lon in players:
+            cells[geohash.encode(lat, lon, PROXIMITY_PRECISION)].append((lat, lon))
+        self._cells = cells
+
+    def run_forever(self, stop: threading.Event = None) -> None:
+        stop = stop or threading.Event()
+        while True:
+            self.refresh()
+            if stop.wait(self._refresh_period):
+                return
+
+    def start(self) -> None:
+        """
+        Start refreshing in the background, if that isn't already happening.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self.run_forever)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def distance_to_nearest_player(self, latitude: float, longitude: float) -> T.Optional[float]:
+        """
+        Meters to the closest player, inf if nobody is within the far radius, or None if player
+        positions aren't known.
+        """
+        cells = self._cells
+        if cells is None:
+            return None
+        nearest = float('inf')
+        for cell in geohash.neighborhood(latitude, longitude, PROXIMITY_PRECISION):
+            for lat, lon in cells.get(cell, ()):
+                nearest = min(nearest, haversine_meters(latitude, longitude, lat, lon))
+        return nearest if nearest <= self._far else float('inf')
+
+    def broadcast_period(self, latitude: float, longitude: float, base_period: float) -> float:
+        """
+        Full rate near a player, backing off linearly to the slowest rate at the far radius.
+        """
+        dist = self.distance_to_nearest_player(latitude, longitude)
+        if dist is None or dist <= self._near:
+            return base_period
+        if math.isinf(dist) or self._far == self._near:
+            return base_period * self._max_backoff
+        fraction = (dist - self._near) / (self._far - self._near)
+        return base_period * (1.0 + fraction * (self._max_backoff - 1.0))
+
+
+_MONITOR: T.Optional[ProximityMonitor] = None
+_MONITOR_LOCK = threading.Lock()
+
+
+def get_monitor() -> ProximityMonitor:
+    """
+    Get the process wide monitor, starting it on first use.
+    """
+    global _MONITOR
+    if _MONITOR is None:
+        with _MONITOR_LOCK:
+            if _MONITOR is None:
+                _MONITOR = ProximityMonitor()
+                _MONITOR.start()
+    return _MONITOR
@@ -0,0 +1,53 @@
+"""
+Douglas-Peucker simplification for routes.
+"""
+import math
+import typing as T
+
+from src.util.distance import EARTH_RADIUS_METERS
+
+
+def simplify_route(points: T.Sequence[T.Tuple[float, float]], tolerance: float) -> T.List[int]:
+    """
+    Simplify a polyline of (latitude, longitude) points, keeping every point that is more than
+    tolerance meters off the simplified line.
+
+    Returns the indices of the points to keep, always including both ends. Points are projected
+    onto a flat plane around the first point, which is fine at city scale.
+    """
+    if len(points) < 3 or tolerance <= 0:
+        return list(range(len(points)))
+
+    lat0 = points[0][0]
+    meters_per_deg_lat = math.pi * EARTH_RADIUS_METERS / 180.0
+    meters_per_deg_lon = meters_per_deg_lat * math.cos(math.radians(lat0))
+    xy = [(lon * meters_per_deg_lon, lat * meters_per_deg_lat) for lat, lon in points]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    # iterative so long routes don't hit the recursion limit
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x0, y0), (x1, y1) = xy[first], xy[last]
+        dx, dy = x1 - x0, y1 - y0
+        seg_len_sq = dx * dx + dy * dy
+        max_dist = -1.0
+        max_idx = first
+        for idx in range(first + 1, last):
+            px, py = xy[idx]
+            if seg_len_sq == 0:
+                dist = math.hypot(px - x0, py - y0)
+            else:
+                # distance to the segment, not the infinite line, so routes that double back are kept
+                t = max(0.0, min(1.0, ((px - x0) * dx + (py - y0) * dy) / seg_len_sq))
+                dist = math.hypot(px - (x0 + t * dx), py - (y0 + t * dy))
+            if dist > max_dist:
+                max_dist = dist
+                max_idx = idx
+        if max_dist > tolerance:
+            keep[max_idx] = True
+            stack.append((first, max_idx))
+            stack.append((max_idx, last))
+
+    return [idx for idx, kept in enumerate(keep) if kept]
@@ -0,0 +1,113 @@
+"""
+Compact file format for precomputed bot trajectories.
+
+A trajectory file is a small header followed by one frame per tick. Every frame holds the
+position of every bot at that tick as pairs of little endian int32s, quantized the same way
+as the compact location encoding, so a frame for N bots is exactly 8N bytes and the replayer
+can stream frames without parsing anything.
+"""
+import struct
+import sys
+import typing as T
+from array import array
+
+from src.util.location_codec import COORDINATE_SCALE
+
+
+TRAJECTORY_MAGIC = b"TRAJ"
+TRAJECTORY_VERSION = 1
+
+# magic, version, bot count, tick count, broadcast period in seconds
+TRAJECTORY_HEADER = struct.Struct("<4sBIId")
+
+
+def _to_little_endian(frame: array) -> array:
+    if sys.byteorder != "little":
+        frame.byteswap()
+    return frame
+
+
+class TrajectoryWriter:
+    """
+    Write trajectories one tick at a time. The tick count in the header is filled in on close.
+    """
+
+    def __init__(self, filename: str, bot_count: int, period: float):
+        self.bot_count = bot_count
+        self.period = period
+        self.tick_count = 0
+        self._file = open(filename, 'wb')
+        self._write_header()
+
+    def _write_header(self) -> None:
+        self._file.write(TRAJECTORY_HEADER.pack(
+            TRAJECTORY_MAGIC,
+            TRAJECTORY_VERSION,
+            self.bot_count,
+            self.tick_count,
+            self.period,
+        ))
+
+    def write_tick(self, positions: T.Sequence[T.Tuple[float, float]]) -> None:
+        if len(positions) != self.bot_count:
+            raise ValueError(f"Expected {self.bot_count} positions, got {len(positions)}")
+        frame = array('i')
+        for lat, lon in positions:
+            frame.append(round(lat * COORDINATE_SCALE))
+            frame.append(round(lon * COORDINATE_SCALE))
+        self._file.write(_to_little_endian(frame).tobytes())
+        self.tick_count += 1
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self._file.seek(0)
+        self._write_header()
+        self._file.close()
+
+    def __enter__(self) -> "TrajectoryWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class TrajectoryReader:
+    """
+    Stream the frames of a trajectory file back out.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            header = f.read(TRAJECTORY_HEADER.size)
+        if len(header) != TRAJECTORY_HEADER.size:
+            raise ValueError(f"Truncated trajectory file {filename}")
+        magic, version, self.bot_count, self.tick_count, self.period = TRAJECTORY_HEADER.unpack(header)
+        if magic != TRAJECTORY_MAGIC:
+            raise ValueError(f"Not a trajectory file: {filename}")
+        if version != TRAJECTORY_VERSION:
+            raise ValueError(f"Unsupported trajectory version {version} in {filename}")
+
+    @property
+    def duration(self) -> float:
+        return self.tick_count * self.period
+
+    def ticks(self) -> T.Iterator[T.List[T.Tuple[float, float]]]:
+        """
+        Yield the (latitude, longitude) of every bot, one tick at a time.
+        """
+        frame_size = 8 * self.bot_count
+        with open(self.filename, 'rb') as f:
+            f.seek(TRAJECTORY_HEADER.size)
+            for _ in range(self.tick_count):
+                raw = f.read(frame_size)
+                if len(raw) != frame_size:
+                    raise ValueError(f"Truncated trajectory file {self.filename}")
+                frame = array('i')
+                frame.frombytes(raw)
+                _to_little_endian(frame)
+                yield [
+                    (frame[idx] / COORDINATE_SCALE, frame[idx + 1] / COORDINATE_SCALE)
+                    for idx in range(0, len(frame), 2)
+                ]